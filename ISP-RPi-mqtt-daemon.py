@@ -14,15 +14,27 @@ import re
 import json
 import os.path
 import argparse
-from time import time, sleep, localtime, strftime
+import hashlib
+import hmac
+import zlib
+from stat import S_ISSOCK
+import heapq
+import bisect
+import itertools
+import math
+from array import array
+from time import time, monotonic, sleep, localtime, strftime
 from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from colorama import init as colorama_init
 from colorama import Fore, Back, Style
 from configparser import ConfigParser
 from unidecode import unidecode
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 import sdnotify
-from signal import signal, SIGPIPE, SIG_DFL
+from signal import signal, SIGPIPE, SIGHUP, SIG_DFL
 signal(SIGPIPE,SIG_DFL)
 
 script_version = "1.5.4"
@@ -50,25 +62,121 @@ opt_verbose = False
 sd_notifier = sdnotify.SystemdNotifier()
 
 # Logging function
-def print_line(text, error=False, warning=False, info=False, verbose=False, debug=False, console=True, sd_notify=False):
-    timestamp = strftime('%Y-%m-%d %H:%M:%S', localtime())
+#  print_line(text, *args, ...) - with args, text is a format string that is only
+#  formatted when the line is actually printed, so a disabled debug or verbose line
+#  costs no more than a couple of flag tests.  Under systemd (a stream connected to
+#  the journal) lines carry a syslog priority prefix instead of colors and a
+#  timestamp.  Repeats of the same error or warning are rate limited.
+
+LOG_REPEAT_WINDOW_IN_SECONDS = 300
+LOG_REPEAT_BURST = 3        # identical errors/warnings printed per window
+LOG_REPEAT_MAX_TRACKED = 256
+
+# syslog priorities as understood by journald
+LOG_PRIORITY_ERROR = 3
+LOG_PRIORITY_WARNING = 4
+LOG_PRIORITY_NOTICE = 5
+LOG_PRIORITY_INFO = 6
+LOG_PRIORITY_DEBUG = 7
+
+def isJournalStream(stream):
+    # systemd sets JOURNAL_STREAM={device}:{inode} for the stream it connected to the journal
+    journalStream = os.environ.get('JOURNAL_STREAM')
+    if not journalStream:
+        return False
+    try:
+        streamStat = os.fstat(stream.fileno())
+    except (AttributeError, OSError, ValueError):
+        return False
+    return journalStream == '{}:{}'.format(streamStat.st_dev, streamStat.st_ino)
+
+log_stdout_to_journal = isJournalStream(sys.stdout)
+log_stderr_to_journal = isJournalStream(sys.stderr)
+
+log_timestamp_second = None
+log_timestamp = ''
+
+def logTimestamp():
+    # formatted at most once a second
+    global log_timestamp_second
+    global log_timestamp
+    now = int(time())
+    if now != log_timestamp_second:
+        log_timestamp = strftime('%Y-%m-%d %H:%M:%S', localtime(now))
+        log_timestamp_second = now
+    return log_timestamp
+
+log_repeats = dict()    # message -> [window start, times seen], oldest window first
+log_repeats_lock = threading.Lock()
+
+def checkLogRepeat(message):
+    # returns (suppress this one, number suppressed in the window just ended)
+    now = monotonic()
+    with log_repeats_lock:
+        repeat = log_repeats.get(message)
+        if repeat is None or now - repeat[0] >= LOG_REPEAT_WINDOW_IN_SECONDS:
+            suppressed = max(repeat[1] - LOG_REPEAT_BURST, 0) if repeat is not None else 0
+            if repeat is not None:
+                del log_repeats[message]    # its new window goes last
+            elif len(log_repeats) >= LOG_REPEAT_MAX_TRACKED:
+                for [oldMessage, oldRepeat] in list(log_repeats.items()):
+                    if now - oldRepeat[0] < LOG_REPEAT_WINDOW_IN_SECONDS:
+                        break
+                    del log_repeats[oldMessage]
+                if len(log_repeats) >= LOG_REPEAT_MAX_TRACKED:
+                    # all still in their window (e.g. a flood of distinct errors): forget the oldest
+                    del log_repeats[next(iter(log_repeats))]
+            log_repeats[message] = [now, 1]
+            return False, suppressed
+        repeat[1] += 1
+        return repeat[1] > LOG_REPEAT_BURST, 0
+
+def print_line(text, *args, error=False, warning=False, info=False, verbose=False, debug=False, console=True, sd_notify=False):
+    if not (error or warning or sd_notify):
+        if info or verbose:
+            if not opt_verbose:
+                return
+        elif debug and not opt_debug:
+            return
+    text = text.format(*args) if args else '{}'.format(text)
+    if sd_notify:
+        timestamp_sd = strftime('%b %d %H:%M:%S', localtime())
+        sd_notifier.notify('STATUS={} - {}.'.format(timestamp_sd, unidecode(text)))
+
     if console:
+        if error or warning:
+            suppress, suppressed = checkLogRepeat(text)
+            if suppress:
+                return
+            if suppressed:
+                text = '{} ({} repeats suppressed)'.format(text, suppressed)
         if error:
-            print(Fore.RED + Style.BRIGHT + '[{}] '.format(timestamp) + Style.RESET_ALL + '{}'.format(text) + Style.RESET_ALL, file=sys.stderr)
+            if log_stderr_to_journal:
+                print('<{}>{}'.format(LOG_PRIORITY_ERROR, text), file=sys.stderr)
+            else:
+                print(Fore.RED + Style.BRIGHT + '[{}] '.format(logTimestamp()) + Style.RESET_ALL + text + Style.RESET_ALL, file=sys.stderr)
         elif warning:
-            print(Fore.YELLOW + '[{}] '.format(timestamp) + Style.RESET_ALL + '{}'.format(text) + Style.RESET_ALL)
+            if log_stdout_to_journal:
+                print('<{}>{}'.format(LOG_PRIORITY_WARNING, text))
+            else:
+                print(Fore.YELLOW + '[{}] '.format(logTimestamp()) + Style.RESET_ALL + text + Style.RESET_ALL)
         elif info or verbose:
             if opt_verbose:
-                print(Fore.GREEN + '[{}] '.format(timestamp) + Fore.YELLOW  + '- ' + '{}'.format(text) + Style.RESET_ALL)
+                if log_stdout_to_journal:
+                    print('<{}>- {}'.format(LOG_PRIORITY_INFO, text))
+                else:
+                    print(Fore.GREEN + '[{}] '.format(logTimestamp()) + Fore.YELLOW  + '- ' + text + Style.RESET_ALL)
         elif debug:
             if opt_debug:
-                print(Fore.CYAN + '[{}] '.format(timestamp) + '- (DBG): ' + '{}'.format(text) + Style.RESET_ALL)
+                if log_stdout_to_journal:
+                    print('<{}>- (DBG): {}'.format(LOG_PRIORITY_DEBUG, text))
+                else:
+                    print(Fore.CYAN + '[{}] '.format(logTimestamp()) + '- (DBG): ' + text + Style.RESET_ALL)
         else:
-            print(Fore.GREEN + '[{}] '.format(timestamp) + Style.RESET_ALL + '{}'.format(text) + Style.RESET_ALL)
-
-    timestamp_sd = strftime('%b %d %H:%M:%S', localtime())
-    if sd_notify:
-        sd_notifier.notify('STATUS={} - {}.'.format(timestamp_sd, unidecode(text)))
+            if log_stdout_to_journal:
+                print('<{}>{}'.format(LOG_PRIORITY_NOTICE, text))
+            else:
+                print(Fore.GREEN + '[{}] '.format(logTimestamp()) + Style.RESET_ALL + text + Style.RESET_ALL)
 
 # Identifier cleanup
 def clean_identifier(name):
@@ -83,13 +191,22 @@ parser = argparse.ArgumentParser(description=project_name, epilog='For further d
 parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
 parser.add_argument("-d", "--debug", help="show debug output", action="store_true")
 parser.add_argument("-s", "--stall", help="TEST: report only the first time", action="store_true")
-parser.add_argument("-c", '--config_dir', help='set directory where config.ini is located', default=sys.path[0])
+parser.add_argument("-c", '--config_dir', help='set directory where config.ini is located (Default: the script\'s, or the --replay corpus\')')
+parser.add_argument("-b", "--benchmark", help="TEST: time N collection cycles at each log level, then exit", type=int, default=0, metavar='N')
+parser.add_argument("--record", help="TEST: run every collector once, saving the files and command output read (and the payload built) in corpus DIR, then exit", metavar='DIR')
+parser.add_argument("--replay", help="TEST: run every collector against corpus DIR and compare the payload with the recorded one (use -b N to time it), then exit", metavar='DIR')
 parse_args = parser.parse_args()
 
-config_dir = parse_args.config_dir
 opt_debug = parse_args.debug
 opt_verbose = parse_args.verbose
 opt_stall = parse_args.stall
+opt_benchmark = parse_args.benchmark
+opt_record = parse_args.record
+opt_replay = parse_args.replay
+config_dir = parse_args.config_dir
+if config_dir is None:
+    # a corpus carries the settings it was recorded with
+    config_dir = opt_replay if opt_replay and os.path.exists(os.path.join(opt_replay, 'config.ini')) else sys.path[0]
 
 print_line(script_info, info=True)
 if opt_verbose:
@@ -98,6 +215,9 @@ if opt_debug:
     print_line('Debug enabled', debug=True)
 if opt_stall:
     print_line('TEST: Stall (no-re-reporting) enabled', debug=True)
+if opt_record and opt_replay:
+    print_line('ERROR: --record and --replay can\'t be used together... Aborting', error=True)
+    sys.exit(1)
 
 # -----------------------------------------------------------------------------
 #  MQTT handlers
@@ -106,22 +226,35 @@ if opt_stall:
 # Eclipse Paho callbacks - http://www.eclipse.org/paho/clients/python/docs/#callbacks
 
 mqtt_client_connected = False
-print_line('* init mqtt_client_connected=[{}]'.format(mqtt_client_connected), debug=True)
+print_line('* init mqtt_client_connected=[{}]', mqtt_client_connected, debug=True)
 mqtt_client_should_attempt_reconnect = True
+# connections established by this process (a session resumed on the first one is a previous run's)
+mqtt_connections = 0
 
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties=None):
     global mqtt_client_connected
+    global mqtt_session_present
+    global mqtt_connections
     if rc == 0:
         print_line('* MQTT connection established', console=True, sd_notify=True)
         print_line('')  # blank line?!
         #_thread.start_new_thread(afterMQTTConnect, ())
+        mqtt_session_present = mqtt_protocol_v5 and bool(flags.get('session present', 0))
+        if mqtt_protocol_v5:
+            # topic aliases don't survive the connection, the broker tells us how many we may use
+            mqtt_topic_aliases.reset(min(getattr(properties, 'TopicAliasMaximum', 0), max_topic_aliases) if mqtt_topic_aliases_enabled else 0)
+            print_line('on_connect() v5 session_present=[{}] topic_aliases=[{}]', mqtt_session_present, mqtt_topic_aliases.maximum, debug=True)
         mqtt_client_connected = True
-        print_line('on_connect() mqtt_client_connected=[{}]'.format(mqtt_client_connected), debug=True)
+        mqtt_connections += 1
+        print_line('on_connect() mqtt_client_connected=[{}]', mqtt_client_connected, debug=True)
+        if commands_enabled and (not mqtt_session_present or mqtt_connections == 1):
+            # a resumed session (v5) still holds our subscription, a clean one forgets it
+            client.subscribe(command_topic, qos=1)
     else:
         print_line('! Connection error with result code {} - {}'.format(str(rc), mqtt.connack_string(rc)), error=True)
         print_line('MQTT Connection error with result code {} - {}'.format(str(rc), mqtt.connack_string(rc)), error=True, sd_notify=True)
         mqtt_client_connected = False   # technically NOT useful but readying possible new shape...
-        print_line('on_connect() mqtt_client_connected=[{}]'.format(mqtt_client_connected), debug=True, error=True)
+        print_line('on_connect() mqtt_client_connected=[{}]', mqtt_client_connected, debug=True, error=True)
         #kill main thread
         os._exit(1)
 
@@ -129,91 +262,460 @@ def on_publish(client, userdata, mid):
     #print_line('* Data successfully published.')
     pass
 
+def on_message(client, userdata, message):
+    if not commands_enabled:
+        return  # a resumed session may still hold the subscription of a previous run
+    handleCommand(message.payload.decode('utf-8', 'replace'))
+
 # Load configuration file
-config = ConfigParser(delimiters=('=', ), inline_comment_prefixes=('#'))
-config.optionxform = str
-try:
+def readConfigFile():
+    newConfig = ConfigParser(delimiters=('=', ), inline_comment_prefixes=('#'))
+    newConfig.optionxform = str
     with open(os.path.join(config_dir, 'config.ini')) as config_file:
-        config.read_file(config_file)
+        newConfig.read_file(config_file)
+    # the [Collectors], [HTTP] and [Relay] sections are optional
+    for optional_section in ['Collectors', 'HTTP', 'Relay']:
+        if not newConfig.has_section(optional_section):
+            newConfig.add_section(optional_section)
+    return newConfig
+
+try:
+    config = readConfigFile()
 except IOError:
     print_line('No configuration file "config.ini"', error=True, sd_notify=True)
     sys.exit(1)
 
-daemon_enabled = config['Daemon'].getboolean('enabled', True)
-
 # This script uses a flag file containing a date/timestamp of when the system was last updated
 default_update_flag_filespec = '/home/pi/bin/lastupd.date'
-update_flag_filespec = config['Daemon'].get('update_flag_filespec', default_update_flag_filespec)
 
 default_base_topic = 'home/nodes'
-base_topic = config['MQTT'].get('base_topic', default_base_topic).lower()
 
 default_sensor_name = 'rpi-reporter'
-sensor_name = config['MQTT'].get('sensor_name', default_sensor_name).lower()
 
 # by default Home Assistant listens to the /homeassistant but it can be changed for a given installation
 default_discovery_prefix = 'homeassistant'
-discovery_prefix = config['MQTT'].get('discovery_prefix', default_discovery_prefix).lower()
 
 # report our RPi values every 5min
 min_interval_in_minutes = 2
 max_interval_in_minutes = 30
 default_interval_in_minutes = 5
-interval_in_minutes = config['Daemon'].getint('interval_in_minutes', default_interval_in_minutes)
+
+# fixed: report every interval from startup,  spread: report on wall clock interval
+#  boundaries plus a per node offset so nodes started together don't report together
+REPORT_SCHEDULING_FIXED = 'fixed'
+REPORT_SCHEDULING_SPREAD = 'spread'
+REPORT_SCHEDULINGS = [REPORT_SCHEDULING_FIXED, REPORT_SCHEDULING_SPREAD]
+
+# sample the cheap values every N seconds between reports so each report carries
+#  min/max/avg/p95 for its interval [0 = off, else 5 up to the report interval]
+min_sample_interval_in_seconds = 5
+default_sample_interval_in_seconds = 0
+
+# optional HTTP metrics endpoint, local only unless asked for
+default_http_bind_address = '127.0.0.1'
+default_http_port = 9110
+
+# relay (aggregator) mode: agents send their reports to a relay which publishes them
+RELAY_MODE_OFF = 'off'
+RELAY_MODE_AGENT = 'agent'
+RELAY_MODE_RELAY = 'relay'
+RELAY_MODES = [RELAY_MODE_OFF, RELAY_MODE_AGENT, RELAY_MODE_RELAY]
+default_relay_address = 'udp://127.0.0.1:9111'
+
+def parseRelayAddress(address):
+    # 'udp://host:port' or 'unix:///path/to/socket' -> (family, sockaddr)
+    if address.startswith('unix://'):
+        return socket.AF_UNIX, address[len('unix://'):]
+    if address.startswith('udp://'):
+        host, sep, port = address[len('udp://'):].rpartition(':')
+        if sep and port.isdigit():
+            if ':' in host:
+                return socket.AF_INET6, (host.strip('[]'), int(port))
+            return socket.AF_INET, (host, int(port))
+    raise ValueError('bad relay address "{}" (use udp://host:port or unix:///path)'.format(address))
+
+max_topic_aliases = 32
+
+# on-demand refresh: at most one report per N seconds, collectors younger than M seconds are not re-run
+default_min_refresh_interval_in_seconds = 15
+default_refresh_max_age_in_seconds = 60
 
 # default domain when hostname -f doesn't return it
 default_domain = ''
-fallback_domain = config['Daemon'].get('fallback_domain', default_domain).lower()
-
 
-# Check configuration
-#
-if (interval_in_minutes < min_interval_in_minutes) or (interval_in_minutes > max_interval_in_minutes):
-    print_line('ERROR: Invalid "interval_in_minutes" found in configuration file: "config.ini"! Must be [{}-{}] Fix and try again... Aborting'.format(min_interval_in_minutes, max_interval_in_minutes), error=True, sd_notify=True)
-    sys.exit(1)
+def readSettings(config):
+    # the settings of config.ini, checked - raises ValueError describing the first bad one
+    #  NOTE: each setting becomes the module global of the same name (see applySettings())
+    if not config.has_section('MQTT') or not config['MQTT']:
+        raise ValueError('No MQTT settings found in configuration file "config.ini"!')
+    settings = OrderedDict()
+    settings['daemon_enabled'] = config['Daemon'].getboolean('enabled', True)
+    settings['update_flag_filespec'] = config['Daemon'].get('update_flag_filespec', default_update_flag_filespec)
+    # as configured, every host's topics live below it
+    settings['mqtt_base_topic'] = config['MQTT'].get('base_topic', default_base_topic).lower()
+    settings['sensor_name'] = config['MQTT'].get('sensor_name', default_sensor_name).lower()
+    settings['instance_id'] = config['MQTT'].get('instance_id', '')
+    settings['discovery_prefix'] = config['MQTT'].get('discovery_prefix', default_discovery_prefix).lower()
+    settings['interval_in_minutes'] = config['Daemon'].getint('interval_in_minutes', default_interval_in_minutes)
+    # adaptive: lengthen the interval (up to the max) while the values are stable and
+    #  shorten it (down to the min) when they change or near their thresholds
+    settings['adaptive_reporting'] = config['Daemon'].getboolean('adaptive_reporting', False)
+    settings['adaptive_min_interval_in_minutes'] = config['Daemon'].getint('adaptive_min_interval_in_minutes', min_interval_in_minutes)
+    settings['adaptive_max_interval_in_minutes'] = config['Daemon'].getint('adaptive_max_interval_in_minutes', max_interval_in_minutes)
+    settings['report_scheduling'] = config['Daemon'].get('report_scheduling', REPORT_SCHEDULING_FIXED).lower()
+    settings['sample_interval_in_seconds'] = config['Daemon'].getint('sample_interval_in_seconds', default_sample_interval_in_seconds)
+    settings['announce_history_sensors'] = config['Daemon'].getboolean('announce_history_sensors', False)
+    settings['fallback_domain'] = config['Daemon'].get('fallback_domain', default_domain).lower()
+    # where the host's /proc, /sys and /var are found (e.g. mounted into a container)
+    settings['fs_root'] = config['Daemon'].get('fs_root', '/')
+    settings['relay_mode'] = config['Relay'].get('mode', RELAY_MODE_OFF).lower()
+    settings['relay_address'] = config['Relay'].get('address', default_relay_address)
+    settings['relay_shared_secret'] = config['Relay'].get('shared_secret', '')
+    # the broker connection (the environment overrides the host, port and credentials)
+    settings['mqtt_hostname'] = os.environ.get('MQTT_HOSTNAME', config['MQTT'].get('hostname', 'localhost'))
+    settings['mqtt_port'] = int(os.environ.get('MQTT_PORT', config['MQTT'].get('port', '1883')))
+    settings['mqtt_keepalive'] = config['MQTT'].getint('keepalive', 60)
+    settings['mqtt_username'] = os.environ.get('MQTT_USERNAME', config['MQTT'].get('username'))
+    settings['mqtt_password'] = os.environ.get('MQTT_PASSWORD', config['MQTT'].get('password', None))
+    settings['mqtt_tls'] = config['MQTT'].getboolean('tls', False)
+    settings['mqtt_tls_ca_cert'] = config['MQTT'].get('tls_ca_cert', None)
+    settings['mqtt_tls_keyfile'] = config['MQTT'].get('tls_keyfile', None)
+    settings['mqtt_tls_certfile'] = config['MQTT'].get('tls_certfile', None)
+    # MQTT protocol: 3.1.1 (default) or 5 (enables the settings below)
+    settings['mqtt_protocol_v5'] = config['MQTT'].get('protocol', '3.1.1').strip() in ['5', '5.0']
+    settings['mqtt_topic_aliases_enabled'] = config['MQTT'].getboolean('topic_aliases', True)
+    # drop undelivered reports older than this (Default, None: 2 of the intervals reported at, see messageExpiry())
+    settings['message_expiry_in_seconds'] = config['MQTT'].getint('message_expiry_in_seconds', None)
+    # broker keeps our session this long after a disconnect so reconnects resume it
+    settings['session_expiry_in_seconds'] = config['MQTT'].getint('session_expiry_in_seconds', 60 * 60)
+    # on-demand refresh via the command topic
+    settings['commands_enabled'] = config['MQTT'].getboolean('commands', True)
+    settings['min_refresh_interval_in_seconds'] = config['MQTT'].getint('min_refresh_interval_in_seconds', default_min_refresh_interval_in_seconds)
+    settings['refresh_max_age_in_seconds'] = config['MQTT'].getint('refresh_max_age_in_seconds', default_refresh_max_age_in_seconds)
+    settings['wireless_interface'] = config['Collectors'].get('wireless_interface', '')
+    settings['top_process_count'] = config['Collectors'].getint('top_processes', 5)
+    settings['max_process_scan_in_ms'] = config['Collectors'].getint('max_process_scan_in_ms', 250)
+    settings['http_enabled'] = config['HTTP'].getboolean('enabled', False)
+    settings['http_bind_address'] = config['HTTP'].get('bind_address', default_http_bind_address)
+    settings['http_port'] = config['HTTP'].getint('port', default_http_port)
+
+    # Check configuration
+    #
+    interval = settings['interval_in_minutes']
+    if (interval < min_interval_in_minutes) or (interval > max_interval_in_minutes):
+        raise ValueError('Invalid "interval_in_minutes" found in configuration file: "config.ini"! Must be [{}-{}]'.format(min_interval_in_minutes, max_interval_in_minutes))
+    if settings['adaptive_reporting'] and not (min_interval_in_minutes <= settings['adaptive_min_interval_in_minutes'] <= interval <= settings['adaptive_max_interval_in_minutes'] <= max_interval_in_minutes):
+        raise ValueError('Invalid "adaptive_min_interval_in_minutes" or "adaptive_max_interval_in_minutes" found in configuration file: "config.ini"! Must be [{}-{}] and enclose "interval_in_minutes"'.format(min_interval_in_minutes, max_interval_in_minutes))
+    if settings['report_scheduling'] not in REPORT_SCHEDULINGS:
+        raise ValueError('Invalid "report_scheduling" found in configuration file: "config.ini"! Must be one of {}'.format(REPORT_SCHEDULINGS))
+    sample_interval = settings['sample_interval_in_seconds']
+    if sample_interval != 0 and ((sample_interval < min_sample_interval_in_seconds) or (sample_interval > interval * 60)):
+        raise ValueError('Invalid "sample_interval_in_seconds" found in configuration file: "config.ini"! Must be 0 or [{}-{}]'.format(min_sample_interval_in_seconds, interval * 60))
+    if settings['min_refresh_interval_in_seconds'] < 1 or settings['refresh_max_age_in_seconds'] < 0:
+        raise ValueError('Invalid "min_refresh_interval_in_seconds" or "refresh_max_age_in_seconds" found in configuration file: "config.ini"! Must be at least 1 and 0')
+    if settings['mqtt_port'] < 1 or settings['mqtt_port'] > 65535 or settings['mqtt_keepalive'] < 0:
+        raise ValueError('Invalid "port" or "keepalive" found in [MQTT] section of configuration file: "config.ini"! Must be [1-65535] and at least 0')
+    if settings['mqtt_tls']:
+        for option in ['mqtt_tls_ca_cert', 'mqtt_tls_keyfile', 'mqtt_tls_certfile']:
+            if settings[option] and not os.path.isfile(settings[option]):
+                raise ValueError('Invalid "{}" found in [MQTT] section of configuration file: "config.ini"! No such file'.format(option[len('mqtt_'):]))
+    if settings['http_port'] < 1 or settings['http_port'] > 65535:
+        raise ValueError('Invalid "port" found in [HTTP] section of configuration file: "config.ini"! Must be [1-65535]')
+    if settings['instance_id'] and not re.match(r'^[A-Za-z0-9_-]+$', settings['instance_id']):
+        raise ValueError('Invalid "instance_id" found in configuration file: "config.ini"! Must be letters, digits, "_" and "-" only')
+    if not os.path.isdir(settings['fs_root']):
+        raise ValueError('Invalid "fs_root" found in configuration file: "config.ini"! Must be a directory')
+    if settings['relay_mode'] not in RELAY_MODES:
+        raise ValueError('Invalid "mode" found in [Relay] section of configuration file: "config.ini"! Must be one of {}'.format(RELAY_MODES))
+    settings['relay_family'], settings['relay_sockaddr'] = None, None
+    if settings['relay_mode'] != RELAY_MODE_OFF:
+        try:
+            settings['relay_family'], settings['relay_sockaddr'] = parseRelayAddress(settings['relay_address'])
+        except ValueError as e:
+            raise ValueError('Invalid "address" found in [Relay] section of configuration file: "config.ini"! {}'.format(e))
+    return settings
+
+def applySettings(settings):
+    global running_settings
+    global daemon_enabled, update_flag_filespec, mqtt_base_topic, sensor_name, instance_id, discovery_prefix
+    global interval_in_minutes, adaptive_reporting, adaptive_min_interval_in_minutes, adaptive_max_interval_in_minutes
+    global report_scheduling, sample_interval_in_seconds, announce_history_sensors, fallback_domain, fs_root
+    global relay_mode, relay_address, relay_shared_secret, relay_family, relay_sockaddr
+    global mqtt_protocol_v5, mqtt_topic_aliases_enabled, message_expiry_in_seconds, session_expiry_in_seconds
+    global commands_enabled, min_refresh_interval_in_seconds, refresh_max_age_in_seconds
+    global wireless_interface, top_process_count, max_process_scan_in_ms
+    global mqtt_hostname, mqtt_port, mqtt_keepalive, mqtt_username, mqtt_password
+    global mqtt_tls, mqtt_tls_ca_cert, mqtt_tls_keyfile, mqtt_tls_certfile
+    global http_enabled, http_bind_address, http_port
+    running_settings = settings
+    daemon_enabled = settings['daemon_enabled']
+    update_flag_filespec = settings['update_flag_filespec']
+    mqtt_base_topic = settings['mqtt_base_topic']
+    sensor_name = settings['sensor_name']
+    instance_id = settings['instance_id']
+    discovery_prefix = settings['discovery_prefix']
+    interval_in_minutes = settings['interval_in_minutes']
+    adaptive_reporting = settings['adaptive_reporting']
+    adaptive_min_interval_in_minutes = settings['adaptive_min_interval_in_minutes']
+    adaptive_max_interval_in_minutes = settings['adaptive_max_interval_in_minutes']
+    report_scheduling = settings['report_scheduling']
+    sample_interval_in_seconds = settings['sample_interval_in_seconds']
+    announce_history_sensors = settings['announce_history_sensors']
+    fallback_domain = settings['fallback_domain']
+    fs_root = settings['fs_root']
+    relay_mode = settings['relay_mode']
+    relay_address = settings['relay_address']
+    relay_shared_secret = settings['relay_shared_secret']
+    relay_family = settings['relay_family']
+    relay_sockaddr = settings['relay_sockaddr']
+    mqtt_hostname = settings['mqtt_hostname']
+    mqtt_port = settings['mqtt_port']
+    mqtt_keepalive = settings['mqtt_keepalive']
+    mqtt_username = settings['mqtt_username']
+    mqtt_password = settings['mqtt_password']
+    mqtt_tls = settings['mqtt_tls']
+    mqtt_tls_ca_cert = settings['mqtt_tls_ca_cert']
+    mqtt_tls_keyfile = settings['mqtt_tls_keyfile']
+    mqtt_tls_certfile = settings['mqtt_tls_certfile']
+    mqtt_protocol_v5 = settings['mqtt_protocol_v5']
+    mqtt_topic_aliases_enabled = settings['mqtt_topic_aliases_enabled']
+    message_expiry_in_seconds = settings['message_expiry_in_seconds']
+    session_expiry_in_seconds = settings['session_expiry_in_seconds']
+    commands_enabled = settings['commands_enabled']
+    min_refresh_interval_in_seconds = settings['min_refresh_interval_in_seconds']
+    refresh_max_age_in_seconds = settings['refresh_max_age_in_seconds']
+    wireless_interface = settings['wireless_interface']
+    top_process_count = settings['top_process_count']
+    max_process_scan_in_ms = settings['max_process_scan_in_ms']
+    http_enabled = settings['http_enabled']
+    http_bind_address = settings['http_bind_address']
+    http_port = settings['http_port']
 
-### Ensure required values within sections of our config are present
-if not config['MQTT']:
-    print_line('ERROR: No MQTT settings found in configuration file "config.ini"! Fix and try again... Aborting', error=True, sd_notify=True)
+try:
+    applySettings(readSettings(config))
+except ValueError as e:
+    print_line('ERROR: {} Fix and try again... Aborting', e, error=True, sd_notify=True)
     sys.exit(1)
 
 print_line('Configuration accepted', console=False, sd_notify=True)
 
+# the interval we report at (adaptive reporting moves it, see adaptReportInterval())
+effective_interval_in_minutes = interval_in_minutes
+
 # -----------------------------------------------------------------------------
 #  RPi variables monitored
 # -----------------------------------------------------------------------------
 
+# names of the values in our monitor payload
+SCRIPT_TIMESTAMP = "timestamp"
+RPI_MODEL = "rpi_model"
+RPI_CONNECTIONS = "ifaces"
+RPI_HOSTNAME = "host_name"
+RPI_FQDN = "fqdn"
+RPI_FQDN_RAW = "fqdn_raw"   # not reported, kept so a reload can re-apply fallback_domain
+RPI_LINUX_RELEASE = "os_release"
+RPI_LINUX_VERSION = "os_kernel_version"
+RPI_UPTIME = "up_time"
+RPI_LOAD_1M = "load_1m"
+RPI_LOAD_5M = "load_5m"
+RPI_LOAD_15M = "load_15m"
+RPI_DATE_LAST_UPDATE = "last_update"
+RPI_DATE_LAST_INSTALL = "last_install"
+RPI_UPGRADES_PENDING = "upgrades_pending"
+RPI_SECURITY_UPGRADES_PENDING = "security_upgrades_pending"
+RPI_FS_SPACE = 'root_fs_total'
+RPI_FS_AVAIL = 'root_fs_used_percent'
+RPI_CPU_TEMP = "cpu_temperature"
+# wireless link (rates are per second over the interval)
+RPI_WIFI_INTERFACE = "wifi_interface"
+RPI_WIFI_LINK_QUALITY = "wifi_link_quality"
+RPI_WIFI_SIGNAL_LEVEL = "wifi_signal_level"
+RPI_WIFI_NOISE_LEVEL = "wifi_noise_level"
+RPI_WIFI_DISCARDED_RETRY = "wifi_discarded_retry_rate"
+RPI_WIFI_MISSED_BEACON = "wifi_missed_beacon_rate"
+RPI_WIFI_TX_BITRATE = "wifi_tx_bitrate"
+RPI_WIFI_RX_BITRATE = "wifi_rx_bitrate"
+RPI_WIFI_TX_RETRIES = "wifi_tx_retry_rate"
+RPI_WIFI_TX_FAILED = "wifi_tx_failed_rate"
+RPI_SCRIPT = "reporter"
+SCRIPT_REPORT_INTERVAL = "report_interval"
+# new memory dictionary
+RPI_MEM_TOTAL = "memory_size"
+RPI_MEM_AVAIL = "memory_available"
+RPI_MEM_FREE = "memory_free"
+RPI_MEM_BUFFERS = "memory_buffers"
+RPI_MEM_CACHED = "memory_cached"
+RPI_MEM_DIRTY = "memory_dirty"
+RPI_MEM_WRITEBACK = "memory_writeback"
+RPI_SWAP_TOTAL = "swap_size"
+RPI_SWAP_FREE = "swap_free"
+RPI_ZRAM_STORED = "zram_stored"
+RPI_ZRAM_USED = "zram_used"
+# payload name, /proc/meminfo name
+MEMINFO_FIELDS = [
+    (RPI_MEM_TOTAL, 'MemTotal'),
+    (RPI_MEM_AVAIL, 'MemAvailable'),
+    (RPI_MEM_FREE, 'MemFree'),
+    (RPI_MEM_BUFFERS, 'Buffers'),
+    (RPI_MEM_CACHED, 'Cached'),
+    (RPI_MEM_DIRTY, 'Dirty'),
+    (RPI_MEM_WRITEBACK, 'Writeback'),
+    (RPI_SWAP_TOTAL, 'SwapTotal'),
+    (RPI_SWAP_FREE, 'SwapFree'),
+]
+# pressure stall percentages (share of the interval tasks were stalled)
+RPI_PSI_CPU_SOME = "psi_cpu_some"
+RPI_PSI_MEM_SOME = "psi_memory_some"
+RPI_PSI_MEM_FULL = "psi_memory_full"
+RPI_PSI_IO_SOME = "psi_io_some"
+RPI_PSI_IO_FULL = "psi_io_full"
+# payload name, /proc/pressure file, line
+PSI_FIELDS = [
+    (RPI_PSI_CPU_SOME, 'cpu', 'some'),
+    (RPI_PSI_MEM_SOME, 'memory', 'some'),
+    (RPI_PSI_MEM_FULL, 'memory', 'full'),
+    (RPI_PSI_IO_SOME, 'io', 'some'),
+    (RPI_PSI_IO_FULL, 'io', 'full'),
+]
+# paging rates (per second over the interval)
+RPI_MAJOR_FAULTS = "major_faults_rate"
+RPI_SWAP_IN = "swap_in_rate"
+RPI_SWAP_OUT = "swap_out_rate"
+# payload name, /proc/vmstat name
+VMSTAT_FIELDS = [
+    (RPI_MAJOR_FAULTS, 'pgmajfault'),
+    (RPI_SWAP_IN, 'pswpin'),
+    (RPI_SWAP_OUT, 'pswpout'),
+]
+# top processes (lists of {pid, name, cpu} and {pid, name, rss})
+RPI_PROCESS_COUNT = "process_count"
+RPI_PROCESS_SCAN_MS = "process_scan_ms"
+RPI_TOP_CPU = "top_cpu"
+RPI_TOP_RSS = "top_memory"
+# cpu values (Vendor, Model Name, Architecture, BogoMIPS, NbrCores)
+RPI_CPU_VENDOR = "cpu_vendor"
+RPI_CPU_MODEL = "cpu_model"
+RPI_CPU_ARCHITECTURE= "cpu_architecture"
+RPI_CPU_BOGOMIPS = "cpu_bogomips"
+RPI_CPU_CORES = "cpu_number_of_cores"
+
 rpi_mac = ''
-rpi_model_raw = ''
-rpi_model = ''
-rpi_connections = ''
-rpi_hostname = ''
-rpi_fqdn = ''
-rpi_linux_release = ''
-rpi_linux_version = ''
-rpi_uptime_raw = ''
-rpi_uptime = ''
-rpi_load_1m = ''
-rpi_load_5m = ''
-rpi_load_15m = ''
-rpi_last_update_date = datetime.min
-#rpi_last_update_date_v2 = datetime.min
-rpi_filesystem_space_raw = ''
-rpi_filesystem_space = ''
-rpi_filesystem_percent = ''
-rpi_cpu_temp = ''
 rpi_mqtt_script = script_info
-rpi_filesystem = []
-# Tuple (Total, Free, Avail.)
-rpi_memory_tuple = ''
-# Tuple (Hardware, Model Name, NbrCores, BogoMIPS, Serial)
-rpi_cpu_tuple = ''
+
+# latest value of every collected field, keyed by payload name
+rpi_values = OrderedDict()
+rpi_values_lock = threading.Lock()
+# bumped (under rpi_values_lock) each time rpi_values changes
+rpi_values_generation = 0
+
+def getValue(key, default=''):
+    with rpi_values_lock:
+        return rpi_values.get(key, default)
+
+# -----------------------------------------------------------------------------
+#  host access: files below fs_root, commands, and recorded corpora
+# -----------------------------------------------------------------------------
+#  The fetch routines read the host only through hostPath() and runCommand(),
+#  so they can be pointed at another root (fs_root, e.g. the host's /proc and
+#  /sys mounted into a container) or at a corpus recorded on a live node:
+#    {corpus}/root/...          the files the collectors read, as read
+#    {corpus}/commands.json     the output of each command they ran
+#    {corpus}/sysconf.json      the host's page size and clock tick (for /proc values)
+#    {corpus}/payload.json      the payload built from them
+#  Recording copies each file before it is read (directories are listed live,
+#  the corpus keeps the entries read below them) and hands the collector the
+#  copy, so the recorded payload is exactly what the corpus replays to.
+
+CORPUS_ROOT_DIR = 'root'
+CORPUS_COMMANDS_FILE = 'commands.json'
+CORPUS_PAYLOAD_FILE = 'payload.json'
+CORPUS_SYSCONF_FILE = 'sysconf.json'
+
+corpus_dir = opt_record or opt_replay
+# command -> its output (stdout and stderr), recorded or being replayed
+corpus_commands = OrderedDict()
+# os.sysconf() name -> value, recorded or being replayed
+corpus_sysconf = OrderedDict()
+
+if opt_record and os.path.exists(os.path.join(opt_record, CORPUS_ROOT_DIR)):
+    print_line('ERROR: corpus "{}" already recorded, record into a new directory... Aborting', opt_record, error=True)
+    sys.exit(1)
+if opt_replay:
+    try:
+        with open(os.path.join(opt_replay, CORPUS_COMMANDS_FILE)) as commandsFile:
+            corpus_commands = json.load(commandsFile, object_pairs_hook=OrderedDict)
+        with open(os.path.join(opt_replay, CORPUS_SYSCONF_FILE)) as sysconfFile:
+            corpus_sysconf = json.load(sysconfFile, object_pairs_hook=OrderedDict)
+    except (OSError, ValueError) as e:
+        print_line('ERROR: can\'t load corpus "{}": {}... Aborting', opt_replay, e, error=True)
+        sys.exit(1)
+
+def corpusPath(path):
+    return os.path.join(corpus_dir, CORPUS_ROOT_DIR, path.lstrip('/'))
+
+def recordHostPath(path, livePath):
+    copyPath = corpusPath(path)
+    try:
+        fileStat = os.stat(livePath)
+        if os.path.isdir(livePath):
+            os.makedirs(copyPath, exist_ok=True)
+            content = None
+        else:
+            with open(livePath, 'rb') as liveFile:
+                content = liveFile.read()
+    except OSError:
+        return livePath     # the collector meets the same error
+    if content is not None:
+        os.makedirs(os.path.dirname(copyPath), exist_ok=True)
+        with open(copyPath, 'wb') as copyFile:
+            copyFile.write(content)
+    # the apt/dpkg dates are file times
+    os.utime(copyPath, ns=(fileStat.st_atime_ns, fileStat.st_mtime_ns))
+    return livePath if content is None else copyPath
+
+def hostPath(path):
+    # where to find the host's (absolute) {path}
+    if opt_replay:
+        return corpusPath(path)
+    livePath = os.path.join(fs_root, path.lstrip('/'))
+    if opt_record:
+        return recordHostPath(path, livePath)
+    return livePath
+
+def hostSysconf(name):
+    # the host's os.sysconf() {name} value
+    if opt_replay:
+        if name not in corpus_sysconf:
+            raise OSError('"{}" not recorded in corpus'.format(name))
+        return corpus_sysconf[name]
+    value = os.sysconf(name)
+    if opt_record:
+        corpus_sysconf[name] = value
+    return value
+
+def runCommand(command):
+    # the output (stdout and stderr) of a shell command
+    if opt_replay:
+        if command not in corpus_commands:
+            raise OSError('"{}" not recorded in corpus'.format(command))
+        return corpus_commands[command]
+    out = subprocess.Popen(command,
+           shell=True,
+           stdout=subprocess.PIPE,
+           stderr=subprocess.STDOUT)
+    stdout, _ = out.communicate()
+    output = stdout.decode('utf-8')
+    if opt_record:
+        corpus_commands[command] = output
+    return output
 
 # -----------------------------------------------------------------------------
 #  monitor variable fetch routines
 #
+#  NOTE: each routine returns a dictionary of { payload name: value } for the
+#   fields its collector declares (see the collector registry below)
+#
 def getDeviceCpuInfo():
-    global rpi_cpu_tuple
     #  cat /proc/cpuinfo | egrep -i "processor|model|bogo|hardware|serial"
     # MULTI-CORE
     #  processor	: 0
@@ -238,12 +740,7 @@ def getDeviceCpuInfo():
     #  Hardware	: BCM2835
     #  Serial		: 00000000131030c0
     #  Model		: Raspberry Pi Zero W Rev 1.1
-    out = subprocess.Popen("lscpu | egrep -i 'vendor|^CPU\(s\)|model name|architecture|bogo'",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout, _ = out.communicate()
-    lines = stdout.decode('utf-8').split("\n")
+    lines = runCommand("lscpu | egrep -i 'vendor|^CPU\(s\)|model name|architecture|bogo'").split("\n")
     trimmedLines = []
     for currLine in lines:
         trimmedLine = currLine.lstrip().rstrip()
@@ -268,51 +765,249 @@ def getDeviceCpuInfo():
             cpu_bogomips = float(currValue)
         if 'CPU' in currLine:
             cpu_cores = int(currValue)
-    # Tuple (Hardware, Model Name, NbrCores, BogoMIPS, Serial)
-    rpi_cpu_tuple = ( cpu_vendor, cpu_model, cpu_architecture, cpu_bogomips, cpu_cores )
-    print_line('rpi_cpu_tuple=[{}]'.format(rpi_cpu_tuple), debug=True)
+    cpuDict = OrderedDict()
+    cpuDict[RPI_CPU_VENDOR] = cpu_vendor
+    cpuDict[RPI_CPU_MODEL] = cpu_model
+    cpuDict[RPI_CPU_ARCHITECTURE] = cpu_architecture
+    cpuDict[RPI_CPU_BOGOMIPS] = cpu_bogomips
+    cpuDict[RPI_CPU_CORES] = cpu_cores
+    print_line('cpuDict=[{}]', cpuDict, debug=True)
+    return cpuDict
 
-def getDeviceMemory():
-    global rpi_memory_tuple
-    #  $ cat /proc/meminfo | egrep -i "mem[TFA]"
+def readMeminfo():
+    #  $ cat /proc/meminfo
     #  MemTotal:         948304 kB
     #  MemFree:           40632 kB
     #  MemAvailable:     513332 kB
-    out = subprocess.Popen("cat /proc/meminfo | egrep -i 'mem[tfa]'",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout, _ = out.communicate()
-    lines = stdout.decode('utf-8').split("\n")
-    trimmedLines = []
-    for currLine in lines:
-        trimmedLine = currLine.lstrip().rstrip()
-        trimmedLines.append(trimmedLine)
-    mem_total = ''
-    mem_free = ''
-    mem_avail = ''
-    for currLine in trimmedLines:
-        lineParts = currLine.split()
-        if 'MemTotal' in currLine:
-            mem_total = float(lineParts[1]) / 1024
-        if 'MemFree' in currLine:
-            mem_free = float(lineParts[1]) / 1024
-        if 'MemAvail' in currLine:
-            mem_avail = float(lineParts[1]) / 1024
-    # Tuple (Total, Free, Avail.)
-    rpi_memory_tuple = ( mem_total, mem_free, mem_avail )
-    print_line('rpi_memory_tuple=[{}]'.format(rpi_memory_tuple), debug=True)
+    #  Buffers:           61764 kB
+    #  ...
+    meminfo = dict()
+    with open(hostPath('/proc/meminfo')) as meminfoFile:
+        for currLine in meminfoFile:
+            lineParts = currLine.split()
+            if len(lineParts) >= 2:
+                meminfo[lineParts[0].rstrip(':')] = int(lineParts[1])
+    return meminfo
+
+def toMegabytes(kilobytes):
+    return round(kilobytes / 1024.0, 2)
+
+def getZramUsage():
+    # zram swap devices: /sys/block/zram{N}/mm_stat = orig_data_size compr_data_size mem_used_total ... (bytes)
+    storedBytes = 0
+    usedBytes = 0
+    found = False
+    try:
+        deviceNames = os.listdir(hostPath('/sys/block'))
+    except OSError:
+        return {}   # no sysfs (e.g. an fs_root without /sys)
+    for deviceName in deviceNames:
+        if not deviceName.startswith('zram'):
+            continue
+        try:
+            with open(hostPath(os.path.join('/sys/block', deviceName, 'mm_stat'))) as mmStatFile:
+                mmStat = mmStatFile.read().split()
+        except OSError:
+            continue
+        storedBytes += int(mmStat[0])
+        usedBytes += int(mmStat[2])
+        found = True
+    if not found:
+        return {}
+    return { RPI_ZRAM_STORED: toMegabytes(storedBytes / 1024.0), RPI_ZRAM_USED: toMegabytes(usedBytes / 1024.0) }
+
+def getDeviceMemory():
+    meminfo = readMeminfo()
+    memoryData = OrderedDict()
+    for [key, name] in MEMINFO_FIELDS:
+        if name in meminfo:
+            memoryData[key] = toMegabytes(meminfo[name])
+    memoryData.update(getZramUsage())
+    print_line('memoryData=[{}]', memoryData, debug=True)
+    return memoryData
+
+# -----------------------------------------------------------------------------
+#  pressure stall information and paging activity
+# -----------------------------------------------------------------------------
+#  Both are reported over the report interval: we keep the previous reading of
+#  the cumulative kernel counters and report how much they moved per second.
+
+class CounterRates:
+    def __init__(self):
+        self.lastCounters = None
+        self.lastTime = None
+
+    def update(self, counters):
+        # returns {name: change per second} since the previous update, None on the first
+        now = monotonic()
+        rates = None
+        if self.lastCounters is not None and now > self.lastTime:
+            elapsed = now - self.lastTime
+            rates = dict()
+            for [name, value] in counters.items():
+                if name in self.lastCounters and value >= self.lastCounters[name]:
+                    rates[name] = (value - self.lastCounters[name]) / elapsed
+        self.lastCounters = counters
+        self.lastTime = now
+        return rates
+
+pressureRates = CounterRates()
+vmstatRates = CounterRates()
+
+def readPressure(resource):
+    #  $ cat /proc/pressure/memory
+    #  some avg10=0.00 avg60=0.00 avg300=0.00 total=0
+    #  full avg10=0.00 avg60=0.00 avg300=0.00 total=0
+    pressure = dict()
+    with open(hostPath('/proc/pressure/{}'.format(resource))) as pressureFile:
+        for currLine in pressureFile:
+            lineParts = currLine.split()
+            if len(lineParts) >= 2:
+                pressure[lineParts[0]] = dict(part.split('=', 1) for part in lineParts[1:])
+    return pressure
+
+def getPressureStall():
+    # kernels without CONFIG_PSI (or booted without psi=1) have no /proc/pressure
+    if not os.path.isdir(hostPath('/proc/pressure')):
+        return {}
+    averages = dict()
+    totals = dict()
+    for [key, resource, kind] in PSI_FIELDS:
+        try:
+            pressure = readPressure(resource)
+        except OSError:
+            continue
+        if kind in pressure:
+            averages[key] = float(pressure[kind]['avg60'])
+            totals[key] = int(pressure[kind]['total'])
+    # total is the stall time in usec: its rate / 10^4 is the percentage of the interval
+    rates = pressureRates.update(totals)
+    pressureData = OrderedDict()
+    for [key, resource, kind] in PSI_FIELDS:
+        if rates is not None and key in rates:
+            pressureData[key] = round(min(rates[key] / 10000.0, 100.0), 2)
+        elif key in averages:
+            # first report: the kernel's own 60 sec average
+            pressureData[key] = averages[key]
+    print_line('pressureData=[{}]', pressureData, debug=True)
+    return pressureData
+
+def getPagingActivity():
+    #  $ cat /proc/vmstat
+    #  ...
+    #  pswpin 0
+    #  pswpout 0
+    #  ...
+    #  pgmajfault 1379
+    wanted = dict((name, key) for [key, name] in VMSTAT_FIELDS)
+    counters = dict()
+    with open(hostPath('/proc/vmstat')) as vmstatFile:
+        for currLine in vmstatFile:
+            lineParts = currLine.split()
+            if len(lineParts) == 2 and lineParts[0] in wanted:
+                counters[wanted[lineParts[0]]] = int(lineParts[1])
+    rates = vmstatRates.update(counters)
+    if rates is None:
+        # nothing to compare against until the next report
+        return {}
+    pagingData = OrderedDict()
+    for [key, name] in VMSTAT_FIELDS:
+        if key in rates:
+            pagingData[key] = round(rates[key], 2)
+    print_line('pagingData=[{}]', pagingData, debug=True)
+    return pagingData
+
+# -----------------------------------------------------------------------------
+#  top processes
+# -----------------------------------------------------------------------------
+#  Scans /proc/[pid]/stat, one read per process, remembering each process's
+#  cpu ticks (and when it read them) so its cpu% comes from the change since
+#  it was last read.  The name is only taken from a process the first time we
+#  see it (same pid and start time) and the scan stops once it has used its
+#  time budget, so a node with a few hundred processes pays a bounded, measured
+#  cost each report.  The next scan resumes after the last pid read, and the
+#  processes it didn't get to are ranked on what their last read gave.
+
+class ProcessTable:
+    def __init__(self):
+        self.ticksPerSecond = hostSysconf('SC_CLK_TCK')
+        self.pageMegabytes = hostSysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+        self.processes = dict()     # pid -> [starttime, name, cpu ticks, read at, cpu%, rss MB]
+        self.resumePid = 0          # an incomplete scan stopped before this pid
+
+    def readStat(self, pid):
+        #  $ cat /proc/1/stat
+        #  1 (systemd) S 0 1 1 0 -1 4194560 ... utime stime ... starttime vsize rss ...
+        with open(hostPath('/proc/{}/stat'.format(pid)), 'rb') as statFile:
+            stat = statFile.read()
+        nameEnd = stat.rfind(b')')
+        fields = stat[nameEnd + 2:].split()
+        # fields[0] is field 3 (state) of proc(5)
+        ticks = int(fields[11]) + int(fields[12])
+        return stat, nameEnd, int(fields[19]), ticks, int(fields[21])
+
+    def scan(self):
+        startTime = monotonic()
+        deadline = startTime + max_process_scan_in_ms / 1000.0
+        pids = sorted(int(entry.name) for entry in os.scandir(hostPath('/proc')) if entry.name.isdigit())
+        # exited processes are forgotten
+        livePids = set(pids)
+        for pid in [pid for pid in self.processes if pid not in livePids]:
+            del self.processes[pid]
+        # carry on where the last scan stopped, wrapping around
+        resumeIndex = bisect.bisect_left(pids, self.resumePid)
+        scanOrder = pids[resumeIndex:] + pids[:resumeIndex]
+        complete = True
+        for pid in scanOrder:
+            now = monotonic()
+            if now > deadline:
+                complete = False
+                self.resumePid = pid
+                break
+            try:
+                stat, nameEnd, startTicks, ticks, rssPages = self.readStat(pid)
+            except (OSError, IndexError, ValueError):
+                self.processes.pop(pid, None)
+                continue    # exited while we looked
+            known = self.processes.get(pid)
+            if known is not None and known[0] == startTicks:
+                name = known[1]
+                elapsed = now - known[3]
+                cpu = (ticks - known[2]) * 100.0 / (elapsed * self.ticksPerSecond) if elapsed > 0 else known[4]
+            else:
+                name = stat[stat.find(b'(') + 1:nameEnd].decode('utf-8', 'replace')
+                cpu = None
+            self.processes[pid] = [startTicks, name, ticks, now, cpu, rssPages * self.pageMegabytes]
+        if complete:
+            self.resumePid = 0
+        usage = [(pid, process[1], process[4], process[5]) for [pid, process] in self.processes.items()]
+        return usage, complete, (monotonic() - startTime) * 1000.0
+
+tracked_processes = ProcessTable()
+
+def getTopProcesses():
+    usage, complete, scanMs = tracked_processes.scan()
+    withCpu = [process for process in usage if process[2] is not None]
+    topCpu = heapq.nlargest(top_process_count, withCpu, key=lambda process: process[2])
+    topRss = heapq.nlargest(top_process_count, usage, key=lambda process: process[3])
+    processData = OrderedDict()
+    processData[RPI_PROCESS_COUNT] = len(usage)
+    processData[RPI_PROCESS_SCAN_MS] = round(scanMs, 1)
+    if not complete:
+        print_line('Process scan stopped at pid {} ({:.0f} ms), the next one resumes there'.format(tracked_processes.resumePid, scanMs), warning=True)
+    # nothing to compare against on the first scan
+    if withCpu:
+        processData[RPI_TOP_CPU] = [dict(pid=pid, name=name, cpu=round(cpu, 1)) for [pid, name, cpu, rss] in topCpu]
+    processData[RPI_TOP_RSS] = [dict(pid=pid, name=name, rss=round(rss, 2)) for [pid, name, cpu, rss] in topRss]
+    print_line('processData=[{}]', processData, debug=True)
+    return processData
 
 def getDeviceModel():
-    global rpi_model
-    global rpi_model_raw
-    global rpi_connections
-    out = subprocess.Popen("/bin/cat /proc/device-tree/model | /bin/sed -e 's/\\x0//g'",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout,_ = out.communicate()
-    rpi_model_raw = stdout.decode('utf-8')
+    try:
+        with open(hostPath('/proc/device-tree/model')) as modelFile:
+            rpi_model_raw = modelFile.read().replace('\x00', '')
+    except OSError:
+        rpi_model_raw = ''  # no device tree, not a RPi
     # now reduce string length (just more compact, same info)
     rpi_model = rpi_model_raw.replace('Raspberry ', 'R').replace('i Model ', 'i 1 Model').replace('Rev ', 'r').replace(' Plus ', '+')
 
@@ -331,40 +1026,40 @@ def getDeviceModel():
         else:
             rpi_connections = 'Ethernet'
 
-    print_line('rpi_model_raw=[{}]'.format(rpi_model_raw), debug=True)
-    print_line('rpi_model=[{}]'.format(rpi_model), debug=True)
-    print_line('rpi_connections=[{}]'.format(rpi_connections), debug=True)
+    print_line('rpi_model_raw=[{}]', rpi_model_raw, debug=True)
+    print_line('rpi_model=[{}]', rpi_model, debug=True)
+    print_line('rpi_connections=[{}]', rpi_connections, debug=True)
+    return { RPI_MODEL: rpi_model, RPI_CONNECTIONS: rpi_connections }
 
 def getLinuxRelease():
-    global rpi_linux_release
-    out = subprocess.Popen("/usr/bin/lsb_release -d -s",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout,_ = out.communicate()
-    rpi_linux_release = stdout.decode('utf-8').rstrip()
-    print_line('rpi_linux_release=[{}]'.format(rpi_linux_release), debug=True)
+    #  $ cat /etc/os-release
+    #  PRETTY_NAME="Raspbian GNU/Linux 10 (buster)"
+    #  ...
+    rpi_linux_release = ''
+    try:
+        with open(hostPath('/etc/os-release')) as releaseFile:
+            for currLine in releaseFile:
+                name, _, value = currLine.strip().partition('=')
+                if name == 'PRETTY_NAME':
+                    rpi_linux_release = value.strip('"\'')
+    except OSError:
+        rpi_linux_release = runCommand("/usr/bin/lsb_release -d -s").rstrip()
+    print_line('rpi_linux_release=[{}]', rpi_linux_release, debug=True)
+    return { RPI_LINUX_RELEASE: rpi_linux_release }
 
 def getLinuxVersion():
-    global rpi_linux_version
-    out = subprocess.Popen("/bin/uname -r",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout,_ = out.communicate()
-    rpi_linux_version = stdout.decode('utf-8').rstrip()
-    print_line('rpi_linux_version=[{}]'.format(rpi_linux_version), debug=True)
+    with open(hostPath('/proc/sys/kernel/osrelease')) as osReleaseFile:
+        rpi_linux_version = osReleaseFile.read().rstrip()
+    print_line('rpi_linux_version=[{}]', rpi_linux_version, debug=True)
+    return { RPI_LINUX_VERSION: rpi_linux_version }
 
 def getHostnames():
-    global rpi_hostname
-    global rpi_fqdn
-    out = subprocess.Popen("/bin/hostname -f",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout,_ = out.communicate()
-    fqdn_raw = stdout.decode('utf-8').rstrip()
-    print_line('fqdn_raw=[{}]'.format(fqdn_raw), debug=True)
+    fqdn_raw = runCommand("/bin/hostname -f").rstrip()
+    print_line('fqdn_raw=[{}]', fqdn_raw, debug=True)
+    return qualifyHostname(fqdn_raw)
+
+def qualifyHostname(fqdn_raw):
+    # NOTE: a config reload with a new fallback_domain re-applies this to RPI_FQDN_RAW
     rpi_hostname = fqdn_raw
     if '.' in fqdn_raw:
         # have good fqdn
@@ -378,68 +1073,70 @@ def getHostnames():
         else:
             rpi_fqdn = rpi_hostname
 
-    print_line('rpi_fqdn=[{}]'.format(rpi_fqdn), debug=True)
-    print_line('rpi_hostname=[{}]'.format(rpi_hostname), debug=True)
+    print_line('rpi_fqdn=[{}]', rpi_fqdn, debug=True)
+    print_line('rpi_hostname=[{}]', rpi_hostname, debug=True)
+    return { RPI_HOSTNAME: rpi_hostname, RPI_FQDN: rpi_fqdn, RPI_FQDN_RAW: fqdn_raw }
+
+def formatUptime(seconds):
+    # as uptime(1) shows it: '3 days, 4:05', '4:05' or '5 min'
+    minutes = int(seconds) // 60
+    days = minutes // (24 * 60)
+    hours = (minutes // 60) % 24
+    minutes = minutes % 60
+    rpi_uptime = '{}:{:02d}'.format(hours, minutes) if hours else '{} min'.format(minutes)
+    if days:
+        rpi_uptime = '{} day{}, {}'.format(days, '' if days == 1 else 's', rpi_uptime)
+    return rpi_uptime
 
 def getUptimeAndLoad():
-    global rpi_uptime_raw
-    global rpi_uptime
-    global rpi_load_1m
-    global rpi_load_5m
-    global rpi_load_15m
-    out = subprocess.Popen("/usr/bin/uptime",
-           shell=True,
-           stdout=subprocess.PIPE,
-           stderr=subprocess.STDOUT)
-    stdout,_ = out.communicate()
-    rpi_uptime_raw = stdout.decode('utf-8').rstrip().lstrip()
-    print_line('rpi_uptime_raw=[{}]'.format(rpi_uptime_raw), debug=True)
-    basicParts = rpi_uptime_raw.split()
-    timeStamp = basicParts[0]
-    lineParts = rpi_uptime_raw.split(',')
-    if('user' in lineParts[1]):
-        rpi_uptime_raw = lineParts[0]
-        rpi_load_1m = lineParts[2].lstrip().split(':')[1]
-        rpi_load_5m = lineParts[3]
-        rpi_load_15m = lineParts[4]
-    else:
-        rpi_uptime_raw = '{}, {}'.format(lineParts[0], lineParts[1])
-        rpi_load_1m = lineParts[3].lstrip().split(':')[1]
-        rpi_load_5m = lineParts[4]
-        rpi_load_15m = lineParts[5]
-    rpi_uptime = rpi_uptime_raw.replace(timeStamp, '').lstrip().replace('up ', '')
-    print_line('rpi_load_1m=[{}]'.format(rpi_load_1m), debug=True)
-    print_line('rpi_load_5m=[{}]'.format(rpi_load_5m), debug=True)
-    print_line('rpi_load_15m=[{}]'.format(rpi_load_15m), debug=True)
-    print_line('rpi_uptime=[{}]'.format(rpi_uptime), debug=True)
+    #  $ cat /proc/uptime
+    #  350735.47 234388.90
+    #  $ cat /proc/loadavg
+    #  0.12 0.15 0.10 1/214 11223
+    with open(hostPath('/proc/uptime')) as uptimeFile:
+        uptimeSeconds = float(uptimeFile.read().split()[0])
+    with open(hostPath('/proc/loadavg')) as loadavgFile:
+        loadParts = loadavgFile.read().split()
+    uptimeData = OrderedDict()
+    uptimeData[RPI_UPTIME] = formatUptime(uptimeSeconds)
+    uptimeData[RPI_LOAD_1M] = float(loadParts[0])
+    uptimeData[RPI_LOAD_5M] = float(loadParts[1])
+    uptimeData[RPI_LOAD_15M] = float(loadParts[2])
+    print_line('uptimeData=[{}]', uptimeData, debug=True)
+    return uptimeData
+
+def defaultRouteInterface():
+    #  $ cat /proc/net/route
+    #  Iface   Destination     Gateway         Flags   RefCnt  Use     Metric  Mask ...
+    #  eth0    00000000        0101A8C0        0003    0       0       202     00000000 ...
+    with open(hostPath('/proc/net/route')) as routeFile:
+        for currLine in routeFile.readlines()[1:]:
+            lineParts = currLine.split()
+            if len(lineParts) >= 8 and lineParts[1] == '00000000' and lineParts[7] == '00000000':
+                return lineParts[0]
+    return None
 
 def loadNetworkIFMAC():
-    global rpi_mac
-    out = subprocess.Popen("cat /sys/class/net/$(ip route show default | awk '/default/ {print $5}')/address",
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT)
-    stdout,_ = out.communicate()
-    rpi_mac = stdout.decode('utf-8').rstrip().lstrip()
-    print_line('rpi_mac=[{}]'.format(rpi_mac), debug=True)
+    rpi_mac = ''
+    try:
+        interfaceName = defaultRouteInterface()
+        if interfaceName is not None:
+            with open(hostPath('/sys/class/net/{}/address'.format(interfaceName))) as addressFile:
+                rpi_mac = addressFile.read().strip()
+    except OSError:
+        pass
+    print_line('rpi_mac=[{}]', rpi_mac, debug=True)
+    return rpi_mac
 
 def getFileSystemDrives():
-    global rpi_filesystem_space_raw
-    global rpi_filesystem_space
-    global rpi_filesystem_percent
-    out = subprocess.Popen("/bin/df -m | /usr/bin/tail -n +2 | /bin/egrep -v 'tmpfs|boot'",
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
-    stdout,_ = out.communicate()
-    lines = stdout.decode('utf-8').split("\n")
+    lines = runCommand("/bin/df -m | /usr/bin/tail -n +2 | /bin/egrep -v 'tmpfs|boot'").split("\n")
     trimmedLines = []
     for currLine in lines:
         trimmedLine = currLine.lstrip().rstrip()
         if len(trimmedLine) > 0:
             trimmedLines.append(trimmedLine)
 
-    print_line('getFileSystemDrives() trimmedLines=[{}]'.format(trimmedLines), debug=True)
+    print_line('getFileSystemDrives() trimmedLines=[{}]', trimmedLines, debug=True)
 
     #  EXAMPLES
     #
@@ -465,11 +1162,12 @@ def getFileSystemDrives():
     # /dev/mmcblk0p1 253 55 198 22% /boot
     # tmpfs 340 0 340 0% /run/user/1000
 
+    filesystemData = OrderedDict()
     for currLine in trimmedLines:
         lineParts = currLine.split()
-        print_line('lineParts({})=[{}]'.format(len(lineParts), lineParts), debug=True)
+        print_line('lineParts({})=[{}]', len(lineParts), lineParts, debug=True)
         if len(lineParts) < 6:
-            print_line('BAD LINE FORMAT, Skipped=[{}]'.format(lineParts), debug=True, warning=True)
+            print_line('BAD LINE FORMAT, Skipped=[{}]', lineParts, debug=True, warning=True)
             continue
         # tuple { total blocks, used%, mountPoint, device }
         #
@@ -484,7 +1182,7 @@ def getFileSystemDrives():
         for percent_field_index in range(len(lineParts) - 2, 1, -1):
             if '%' in lineParts[percent_field_index]:
                 break;
-        print_line('percent_field_index=[{}]'.format(percent_field_index), debug=True)
+        print_line('percent_field_index=[{}]', percent_field_index, debug=True)
 
         total_size_idx = percent_field_index - 3
         mount_idx = percent_field_index + 1
@@ -493,23 +1191,23 @@ def getFileSystemDrives():
         device = lineParts[0]
         if total_size_idx != 1:
             device = '{} {}'.format(lineParts[0], lineParts[1])
-        print_line('device=[{}]'.format(device), debug=True)
+        print_line('device=[{}]', device, debug=True)
 
         # do we have a two part mount point?
         mount_point = lineParts[mount_idx]
         if len(lineParts) - 1 > mount_idx:
             mount_point = '{} {}'.format(lineParts[mount_idx], lineParts[mount_idx + 1])
-        print_line('mount_point=[{}]'.format(mount_point), debug=True)
+        print_line('mount_point=[{}]', mount_point, debug=True)
 
         total_size = '{:.0f}'.format(next_power_of_2(lineParts[total_size_idx]))
         newTuple = ( total_size, lineParts[percent_field_index].replace('%',''),  mount_point, device )
-        print_line('newTuple=[{}]'.format(newTuple), debug=True)
+        print_line('newTuple=[{}]', newTuple, debug=True)
         if newTuple[2] == '/':
-            rpi_filesystem_space_raw = currLine
-            rpi_filesystem_space = newTuple[0]
-            rpi_filesystem_percent = newTuple[1]
-            print_line('rpi_filesystem_space=[{}GB]'.format(newTuple[0]), debug=True)
-            print_line('rpi_filesystem_percent=[{}]'.format(newTuple[1]), debug=True)
+            filesystemData[RPI_FS_SPACE] = int(newTuple[0], 10)
+            filesystemData[RPI_FS_AVAIL] = int(newTuple[1], 10)
+            print_line('rpi_filesystem_space=[{}GB]', newTuple[0], debug=True)
+            print_line('rpi_filesystem_percent=[{}]', newTuple[1], debug=True)
+    return filesystemData
 
 def next_power_of_2(size):
     size_as_nbr = int(size) - 1
@@ -524,93 +1222,1048 @@ def getIPCmd():
     elif os.path.exists(cmd_locn2) == True:
         desiredCommand = cmd_locn2
     if desiredCommand != '':
-        print_line('Found IP(8)=[{}]'.format(desiredCommand), debug=True)
+        print_line('Found IP(8)=[{}]', desiredCommand, debug=True)
     return desiredCommand
 
 def getSystemTemperature():
-    global rpi_cpu_temp
-
-    out = subprocess.Popen("/bin/cat /sys/class/thermal/thermal_zone0/temp",
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT)
-    stdout,_ = out.communicate()
-    rpi_cpu_temp_raw = stdout.decode('utf-8').rstrip()
+    with open(hostPath('/sys/class/thermal/thermal_zone0/temp')) as tempFile:
+        rpi_cpu_temp_raw = tempFile.read().rstrip()
     rpi_cpu_temp = float(rpi_cpu_temp_raw) / 1000.0
-    print_line('rpi_cpu_temp=[{}]'.format(rpi_cpu_temp), debug=True)
+    print_line('rpi_cpu_temp=[{}]', rpi_cpu_temp, debug=True)
+    return { RPI_CPU_TEMP: forceSingleDigit(rpi_cpu_temp) }
 
-def getLastUpdateDate():
-    global rpi_last_update_date
+# -----------------------------------------------------------------------------
+#  wireless link
+# -----------------------------------------------------------------------------
+
+WIRELESS_FILESPEC = '/proc/net/wireless'
+wirelessRates = CounterRates()
+wirelessLinkRates = CounterRates()
+
+def readWireless():
+    #  $ cat /proc/net/wireless
+    #  Inter-| sta-|   Quality        |   Discarded packets               | Missed | WE
+    #   face | tus | link level noise |  nwid  crypt   frag  retry   misc | beacon | 22
+    #   wlan0: 0000   54.  -56.  -256        0      0      0      0      0        0
+    interfaces = OrderedDict()
+    with open(hostPath(WIRELESS_FILESPEC)) as wirelessFile:
+        for currLine in wirelessFile.readlines()[2:]:
+            interfaceName, _, values = currLine.partition(':')
+            lineParts = [part.rstrip('.') for part in values.split()]
+            if len(lineParts) >= 10:
+                interfaces[interfaceName.strip()] = lineParts
+    return interfaces
+
+def wirelessInterface(interfaces):
+    # the configured one, else the first listed
+    if wireless_interface:
+        return wireless_interface if wireless_interface in interfaces else None
+    return next(iter(interfaces), None)
+
+def hasWirelessInterface():
+    try:
+        return len(readWireless()) > 0
+    except OSError:
+        return False
+
+def getWirelessQuality():
+    interfaces = readWireless()
+    interfaceName = wirelessInterface(interfaces)
+    if interfaceName is None:
+        return {}
+    lineParts = interfaces[interfaceName]
+    wirelessData = OrderedDict()
+    wirelessData[RPI_WIFI_INTERFACE] = interfaceName
+    wirelessData[RPI_WIFI_LINK_QUALITY] = float(lineParts[1])
+    wirelessData[RPI_WIFI_SIGNAL_LEVEL] = float(lineParts[2])
+    wirelessData[RPI_WIFI_NOISE_LEVEL] = float(lineParts[3])
+    rates = wirelessRates.update({ RPI_WIFI_DISCARDED_RETRY: int(lineParts[7]), RPI_WIFI_MISSED_BEACON: int(lineParts[9]) })
+    if rates is not None:
+        for [key, rate] in rates.items():
+            wirelessData[key] = round(rate, 3)
+    print_line('wirelessData=[{}]', wirelessData, debug=True)
+    return wirelessData
+
+def getWirelessLink():
+    #  $ iw dev wlan0 station dump
+    #  Station b8:27:eb:xx:xx:xx (on wlan0)
+    #          ...
+    #          tx retries:     2816
+    #          tx failed:      12
+    #          signal:         -56 [-56, -58] dBm
+    #          tx bitrate:     72.2 MBit/s MCS 7 short GI
+    #          rx bitrate:     65.0 MBit/s MCS 6
+    try:
+        interfaceName = wirelessInterface(readWireless())
+    except OSError:
+        interfaceName = None
+    if interfaceName is None:
+        return {}
+    station = dict()
+    for currLine in runCommand("iw dev {} station dump".format(interfaceName)).split("\n"):
+        name, sep, value = currLine.strip().partition(':')
+        if sep and value.strip():
+            station[name] = value.split()[0]
+    linkData = OrderedDict()
+    for [key, name] in [(RPI_WIFI_TX_BITRATE, 'tx bitrate'), (RPI_WIFI_RX_BITRATE, 'rx bitrate')]:
+        if name in station:
+            linkData[key] = float(station[name])
+    counters = dict((key, int(station[name])) for [key, name] in [(RPI_WIFI_TX_RETRIES, 'tx retries'), (RPI_WIFI_TX_FAILED, 'tx failed')] if name in station)
+    rates = wirelessLinkRates.update(counters)
+    if rates is not None:
+        for [key, rate] in rates.items():
+            linkData[key] = round(rate, 3)
+    print_line('linkData=[{}]', linkData, debug=True)
+    return linkData
+
+# -----------------------------------------------------------------------------
+#  thermal zones and hwmon sensors
+# -----------------------------------------------------------------------------
+#  The temperature sources are found once, by walking /sys/class/thermal and
+#  /sys/class/hwmon, and their paths kept.  Each read only lists those two
+#  directories to notice a device coming or going (and a source failing to read
+#  triggers the same re-scan).  Every source is its own field and discovery entity.
+
+THERMAL_CLASS_DIR = '/sys/class/thermal'
+HWMON_CLASS_DIR = '/sys/class/hwmon'
+
+def readSysfsValue(path):
+    with open(hostPath(path)) as sysfsFile:
+        return sysfsFile.read().strip()
+
+def temperatureKey(name):
+    return 'temp_{}'.format(re.sub('[^a-z0-9]+', '_', name.lower()).strip('_'))
+
+class TemperatureSources:
+    def __init__(self):
+        self.listing = None
+        self.sources = OrderedDict()    # payload name -> (title, path)
+
+    def classListing(self):
+        listing = []
+        for classDir in [THERMAL_CLASS_DIR, HWMON_CLASS_DIR]:
+            try:
+                listing.append(sorted(os.listdir(hostPath(classDir))))
+            except OSError:
+                listing.append([])
+        return listing
+
+    def addSource(self, sources, title, path, device):
+        # two devices of a kind (e.g. NVMe drives, both 'nvme Composite') are told apart by their sysfs name
+        key = temperatureKey(title)
+        if key in sources:
+            title = '{} {}'.format(title, device)
+            key = temperatureKey(title)
+        sources[key] = (title, path)
+
+    def scan(self):
+        sources = OrderedDict()
+        thermalZones, hwmons = self.classListing()
+        for zone in thermalZones:
+            if not zone.startswith('thermal_zone'):
+                continue
+            zoneDir = os.path.join(THERMAL_CLASS_DIR, zone)
+            try:
+                zoneType = readSysfsValue(os.path.join(zoneDir, 'type'))
+            except OSError:
+                zoneType = zone
+            self.addSource(sources, zoneType, os.path.join(zoneDir, 'temp'), zone)
+        zoneKeys = set(sources.keys())
+        for hwmon in hwmons:
+            hwmonDir = os.path.join(HWMON_CLASS_DIR, hwmon)
+            try:
+                hwmonName = readSysfsValue(os.path.join(hwmonDir, 'name'))
+                inputs = sorted(entry for entry in os.listdir(hostPath(hwmonDir)) if re.match(r'temp\d+_input$', entry))
+            except OSError:
+                continue
+            for inputName in inputs:
+                channel = inputName[:-len('_input')]
+                try:
+                    label = readSysfsValue(os.path.join(hwmonDir, channel + '_label'))
+                except OSError:
+                    label = channel if len(inputs) > 1 else ''
+                title = '{} {}'.format(hwmonName, label).strip()
+                # thermal zones also show up as hwmon devices (named after the zone's type)
+                if temperatureKey(title) in zoneKeys:
+                    continue
+                self.addSource(sources, title, os.path.join(hwmonDir, inputName), hwmon)
+        self.sources = sources
+        print_line('temperature sources=[{}]', sources, debug=True)
+
+    def hasChanged(self):
+        listing = self.classListing()
+        changed = listing != self.listing
+        self.listing = listing
+        return changed
+
+    def read(self):
+        values = OrderedDict()
+        for [key, [title, path]] in self.sources.items():
+            try:
+                values[key] = forceSingleDigit(float(readSysfsValue(path)) / 1000.0)
+            except (OSError, ValueError):
+                self.listing = None     # gone? re-scan next time
+        return values
+
+temperatureSources = TemperatureSources()
+
+def temperatureFields():
+    return [(key, dict(unit='°C', device_class='temperature', sensor=key, title='Temp {}'.format(title), icon='mdi:thermometer', history=True)) for [key, [title, path]] in temperatureSources.sources.items()]
+
+def getTemperatureSweep():
+    global discovery_stale
+    if temperatureSources.hasChanged():
+        oldKeys = list(temperatureSources.sources.keys())
+        temperatureSources.scan()
+        if list(temperatureSources.sources.keys()) != oldKeys:
+            # hotplug: the collector's fields (and so our discovery entities) follow the sources
+            with rpi_values_lock:
+                collectorRegistry['thermal'].fields = OrderedDict(temperatureFields())
+                updateCollectorHistory(collectorRegistry['thermal'], oldKeys)
+            discovery_stale = True
+    temperatureData = temperatureSources.read()
+    print_line('temperatureData=[{}]', temperatureData, debug=True)
+    return temperatureData
+
+def forceSingleDigit(temperature):
+    tempInterp = '{:.1f}'.format(temperature)
+    return float(tempInterp)
+
+def formatDate(date):
+    if date != datetime.min:
+        return date.astimezone().replace(microsecond=0).isoformat()
+    return ''
+
+# -----------------------------------------------------------------------------
+#  package activity tracking
+# -----------------------------------------------------------------------------
+#  Instead of grep | sort over the whole of the dpkg logs on every check we
+#  remember the inode and byte offset of dpkg.log and only parse what has been
+#  appended since.  The apt dates are plain os.stat() calls and the pending
+#  upgrade count is worked out from the apt lists cache (only when it changes).
+
+def dpkgCharOrder(c):
+    # ordering used by dpkg for the non-digit parts of a version
+    if c == '~':
+        return -1
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+def dpkgCompareFragment(a, b):
+    i = 0
+    j = 0
+    while i < len(a) or j < len(b):
+        # compare non-digit prefixes
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac = dpkgCharOrder(a[i]) if i < len(a) and not a[i].isdigit() else 0
+            bc = dpkgCharOrder(b[j]) if j < len(b) and not b[j].isdigit() else 0
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        # then the numeric parts
+        startI = i
+        while i < len(a) and a[i].isdigit():
+            i += 1
+        startJ = j
+        while j < len(b) and b[j].isdigit():
+            j += 1
+        numA = int(a[startI:i]) if i > startI else 0
+        numB = int(b[startJ:j]) if j > startJ else 0
+        if numA != numB:
+            return numA - numB
+    return 0
+
+def splitDpkgVersion(version):
+    epoch = 0
+    if ':' in version:
+        epochStr, version = version.split(':', 1)
+        epoch = int(epochStr) if epochStr.isdigit() else 0
+    revision = ''
+    if '-' in version:
+        version, revision = version.rsplit('-', 1)
+    return epoch, version, revision
+
+def dpkgCompareVersions(a, b):
+    # returns <0, 0, >0 like dpkg --compare-versions
+    epochA, upstreamA, revisionA = splitDpkgVersion(a)
+    epochB, upstreamB, revisionB = splitDpkgVersion(b)
+    if epochA != epochB:
+        return epochA - epochB
+    result = dpkgCompareFragment(upstreamA, upstreamB)
+    if result != 0:
+        return result
+    return dpkgCompareFragment(revisionA, revisionB)
+
+def readControlStanzas(filespec, wanted):
+    # yields a dict (of the wanted fields only) per stanza of a dpkg/apt control file
+    stanza = {}
+    with open(hostPath(filespec), 'rb') as controlFile:
+        for line in controlFile:
+            if line == b'\n':
+                if stanza:
+                    yield stanza
+                    stanza = {}
+                continue
+            if line[:1] in (b' ', b'\t'):
+                continue    # continuation line
+            name, sep, value = line.partition(b':')
+            if sep and name in wanted:
+                stanza[name.decode('ascii')] = value.strip().decode('utf-8', 'replace')
+    if stanza:
+        yield stanza
+
+class PackageActivityTracker:
+    DPKG_LOG_FILESPEC = '/var/log/dpkg.log'
+    DPKG_ROTATED_LOG_FILESPEC = '/var/log/dpkg.log.1'
+    DPKG_STATUS_FILESPEC = '/var/lib/dpkg/status'
     # apt-get update writes to following dir (so date changes on update)
-    apt_listdir_filespec = '/var/lib/apt/lists/partial'
+    APT_LISTDIR_FILESPEC = '/var/lib/apt/lists/partial'
     # apt-get dist-upgrade | autoremove update the following file when actions are taken
-    apt_lockdir_filespec = '/var/lib/dpkg/lock'
-    cmdString = '/bin/ls -ltrd {} {}'.format(apt_listdir_filespec, apt_lockdir_filespec)
-    out = subprocess.Popen(cmdString,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
-    stdout,_ = out.communicate()
-    lines = stdout.decode('utf-8').split("\n")
-    trimmedLines = []
-    for currLine in lines:
-        trimmedLine = currLine.lstrip().rstrip()
-        if len(trimmedLine) > 0:
-            trimmedLines.append(trimmedLine)
-    print_line('trimmedLines=[{}]'.format(trimmedLines), debug=True)
-
-    fileSpec_latest = ''
-    if len(trimmedLines) > 0:
-        lastLineIdx = len(trimmedLines) - 1
-        lineParts = trimmedLines[lastLineIdx].split()
-        if len(lineParts) > 0:
-            lastPartIdx = len(lineParts) - 1
-            fileSpec_latest = lineParts[lastPartIdx]
-    print_line('fileSpec_latest=[{}]'.format(fileSpec_latest), debug=True)
-
-    fileModDateInSeconds = os.path.getmtime(fileSpec_latest)
-    fileModDate = datetime.fromtimestamp(fileModDateInSeconds)
-    rpi_last_update_date = fileModDate.replace(tzinfo=local_tz)
-    print_line('rpi_last_update_date=[{}]'.format(rpi_last_update_date), debug=True)
+    APT_LOCK_FILESPEC = '/var/lib/dpkg/lock'
+    APT_LISTS_DIR = '/var/lib/apt/lists'
+    READ_CHUNK_SIZE = 64 * 1024
+    INSTALLED_MARKER = b' status installed '
+
+    def __init__(self):
+        self.log_inode = None
+        self.log_offset = 0
+        self.log_partial_line = b''
+        self.last_install_stamp = ''    # 'YYYY-MM-DD HH:MM:SS' from the log
+        self.lists_signature = None
+        self.pending_upgrades = 0
+        self.pending_security_upgrades = 0
+
+    def lastUpdateDate(self):
+        latestModTime = None
+        for filespec in (self.APT_LISTDIR_FILESPEC, self.APT_LOCK_FILESPEC):
+            try:
+                fileModTime = os.stat(hostPath(filespec)).st_mtime
+            except OSError:
+                continue
+            if latestModTime is None or fileModTime > latestModTime:
+                latestModTime = fileModTime
+        if latestModTime is None:
+            return datetime.min
+        return datetime.fromtimestamp(latestModTime).replace(tzinfo=local_tz)
+
+    def lastInstallDate(self):
+        self.scanInstallLog()
+        if self.last_install_stamp == '':
+            return datetime.min
+        # Example:
+        #   2020-07-22 17:08:26 status installed python3-tzlocal:all 1.3-1
+        return datetime.strptime(self.last_install_stamp, '%Y-%m-%d %H:%M:%S').replace(tzinfo=local_tz)
+
+    def scanInstallLog(self):
+        try:
+            logStat = os.stat(hostPath(self.DPKG_LOG_FILESPEC))
+        except OSError:
+            print_line('no {} to scan', self.DPKG_LOG_FILESPEC, debug=True)
+            return
+        if self.log_inode is None:
+            # first look, the latest install may be in last rotation's log
+            self.readLogFrom(self.DPKG_ROTATED_LOG_FILESPEC, 0)
+        elif logStat.st_ino != self.log_inode:
+            # log was rotated, finish what was appended to the old log before the move
+            try:
+                if os.stat(hostPath(self.DPKG_ROTATED_LOG_FILESPEC)).st_ino == self.log_inode:
+                    self.readLogFrom(self.DPKG_ROTATED_LOG_FILESPEC, self.log_offset)
+            except OSError:
+                pass
+            self.log_offset = 0
+        elif logStat.st_size < self.log_offset:
+            # log was truncated in place
+            self.log_offset = 0
+        self.log_inode = logStat.st_ino
+        if logStat.st_size != self.log_offset:
+            self.log_offset = self.readLogFrom(self.DPKG_LOG_FILESPEC, self.log_offset)
+        print_line('dpkg.log inode=[{}] offset=[{}] last_install=[{}]', self.log_inode, self.log_offset, self.last_install_stamp, debug=True)
+
+    def readLogFrom(self, filespec, offset):
+        # parse appended complete lines, returns the offset we got to
+        self.log_partial_line = b''
+        try:
+            with open(hostPath(filespec), 'rb') as logFile:
+                logFile.seek(offset)
+                while True:
+                    chunk = logFile.read(self.READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    offset += len(chunk)
+                    lines = (self.log_partial_line + chunk).split(b'\n')
+                    self.log_partial_line = lines.pop()
+                    for line in lines:
+                        if self.INSTALLED_MARKER in line:
+                            stamp = line[:19].decode('utf-8', 'replace')
+                            if stamp > self.last_install_stamp:
+                                self.last_install_stamp = stamp
+        except OSError:
+            return offset
+        # leave a trailing partial line to be re-read once it is complete
+        return offset - len(self.log_partial_line)
+
+    def listsSignature(self, listFilespecs):
+        signature = []
+        for filespec in listFilespecs + [self.DPKG_STATUS_FILESPEC]:
+            try:
+                fileStat = os.stat(hostPath(filespec))
+            except OSError:
+                continue
+            signature.append((filespec, fileStat.st_mtime, fileStat.st_size))
+        return tuple(signature)
+
+    def pendingUpgrades(self):
+        # the same count 'apt list --upgradable' gives with default pinning, recomputed
+        #  only when apt's lists or dpkg's status have changed
+        try:
+            listFilespecs = sorted([os.path.join(self.APT_LISTS_DIR, name) for name in os.listdir(hostPath(self.APT_LISTS_DIR)) if name.endswith('_Packages')])
+        except OSError:
+            listFilespecs = []
+        signature = self.listsSignature(listFilespecs)
+        if signature == self.lists_signature:
+            return self.pending_upgrades, self.pending_security_upgrades
+        self.lists_signature = signature
+
+        installed = {}
+        for stanza in readControlStanzas(self.DPKG_STATUS_FILESPEC, (b'Package', b'Status', b'Architecture', b'Version')):
+            if stanza.get('Status', '').endswith(' installed') and 'Version' in stanza:
+                installed[(stanza.get('Package'), stanza.get('Architecture'))] = stanza['Version']
+
+        candidates = {}
+        for filespec in listFilespecs:
+            isSecurity = 'security' in os.path.basename(filespec)
+            for stanza in readControlStanzas(filespec, (b'Package', b'Architecture', b'Version')):
+                key = (stanza.get('Package'), stanza.get('Architecture'))
+                if key not in installed or 'Version' not in stanza:
+                    continue
+                if dpkgCompareVersions(stanza['Version'], installed[key]) <= 0:
+                    continue
+                if key not in candidates or dpkgCompareVersions(stanza['Version'], candidates[key][0]) > 0:
+                    candidates[key] = (stanza['Version'], isSecurity)
+
+        self.pending_upgrades = len(candidates)
+        self.pending_security_upgrades = len([key for key in candidates if candidates[key][1]])
+        print_line('pending upgrades=[{}], security=[{}]', self.pending_upgrades, self.pending_security_upgrades, debug=True)
+        return self.pending_upgrades, self.pending_security_upgrades
+
+packageTracker = PackageActivityTracker()
+
+def getLastUpdateDate():
+    rpi_last_update_date = packageTracker.lastUpdateDate()
+    print_line('rpi_last_update_date=[{}]', rpi_last_update_date, debug=True)
+    return { RPI_DATE_LAST_UPDATE: formatDate(rpi_last_update_date) }
 
 def to_datetime(time):
     return datetime.fromordinal(int(time)) + datetime.timedelta(time % 1)
 
 def getLastInstallDate():
-    global rpi_last_update_date
-    #apt_log_filespec = '/var/log/dpkg.log'
-    #apt_log_filespec2 = '/var/log/dpkg.log.1'
-    out = subprocess.Popen("/bin/grep --binary-files=text 'status installed' /var/log/dpkg.log /var/log/dpkg.log.1 2>/dev/null | sort | tail -1",
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
-    stdout,_ = out.communicate()
-    last_installed_pkg_raw = stdout.decode('utf-8').rstrip().replace('/var/log/dpkg.log:','').replace('/var/log/dpkg.log.1:','')
-    print_line('last_installed_pkg_raw=[{}]'.format(last_installed_pkg_raw), debug=True)
-    line_parts = last_installed_pkg_raw.split()
-    if len(line_parts) > 1:
-        pkg_date_string = '{} {}'.format(line_parts[0], line_parts[1])
-        print_line('pkg_date_string=[{}]'.format(pkg_date_string), debug=True)
-        # Example:
-        #   2020-07-22 17:08:26 status installed python3-tzlocal:all 1.3-1
+    rpi_last_install_date = packageTracker.lastInstallDate()
+    print_line('rpi_last_install_date=[{}]', rpi_last_install_date, debug=True)
+    return { RPI_DATE_LAST_INSTALL: formatDate(rpi_last_install_date) }
 
-        pkg_install_date = datetime.strptime(pkg_date_string, '%Y-%m-%d %H:%M:%S').replace(tzinfo=local_tz)
-        rpi_last_update_date  = pkg_install_date
+def getPendingUpgrades():
+    pending, pending_security = packageTracker.pendingUpgrades()
+    return { RPI_UPGRADES_PENDING: pending, RPI_SECURITY_UPGRADES_PENDING: pending_security }
 
-    print_line('rpi_last_update_date=[{}]'.format(rpi_last_update_date), debug=True)
+def getReporterInfo():
+    return { RPI_SCRIPT: rpi_mqtt_script.replace('.py', ''), SCRIPT_REPORT_INTERVAL: effective_interval_in_minutes }
 
+# -----------------------------------------------------------------------------
+#  Metric history (between reports)
+# -----------------------------------------------------------------------------
+#  When sample_interval_in_seconds is set the cheap collectors are also run
+#  between reports and every numeric field declared with history=True keeps its
+#  samples in a fixed size ring buffer.  Samples live unboxed in an array('f'),
+#  so memory stays bounded and no python object is kept per sample; closing a
+#  window makes a single pass over it (each sample is boxed once, then dropped)
+#  computing all the aggregates, p95 from a heap of the top 5% only.
+
+HISTORY_AGGREGATES = ['min', 'max', 'avg', 'p95']
+MAX_HISTORY_SAMPLES = 4096
+
+class MetricHistory:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.samples = array('f', bytes(4 * capacity))
+        self.next_index = 0
+        self.window_count = 0   # samples added since last aggregate()
+
+    def add(self, value):
+        self.samples[self.next_index] = value
+        self.next_index = (self.next_index + 1) % self.capacity
+        self.window_count += 1
+
+    def windowParts(self):
+        # the samples of the current window as (at most two) memoryview slices, oldest first
+        count = min(self.window_count, self.capacity)
+        start = (self.next_index - count) % self.capacity
+        view = memoryview(self.samples)
+        if start + count <= self.capacity:
+            return count, [view[start:start + count]]
+        return count, [view[start:], view[:self.next_index]]
+
+    def aggregate(self):
+        # returns { 'min': , 'max': , 'avg': , 'p95': } of the window and starts a new one
+        count, parts = self.windowParts()
+        self.window_count = 0
+        if count == 0:
+            return None
+        # nearest-rank p95: only the top (count - rank + 1) samples are ever held
+        rank = int(math.ceil(0.95 * count))
+        topCount = count - rank + 1
+        topSamples = []
+        low = high = None
+        total = 0.0
+        for sample in itertools.chain(*parts):
+            total += sample
+            if low is None or sample < low:
+                low = sample
+            if high is None or sample > high:
+                high = sample
+            if len(topSamples) < topCount:
+                heapq.heappush(topSamples, sample)
+            elif sample > topSamples[0]:
+                heapq.heapreplace(topSamples, sample)
+        aggregates = OrderedDict()
+        aggregates['min'] = low
+        aggregates['max'] = high
+        aggregates['avg'] = total / count
+        aggregates['p95'] = topSamples[0]
+        return aggregates
+
+# one history per field declaring history=True (guarded by rpi_values_lock)
+rpi_history = OrderedDict()
+
+def historyKey(key, aggregate):
+    return '{}_{}'.format(key, aggregate)
+
+def historyCapacity():
+    # samples taken in the longest interval we report at
+    longestInterval = adaptive_max_interval_in_minutes if adaptive_reporting else interval_in_minutes
+    return min(int(math.ceil(longestInterval * 60.0 / sample_interval_in_seconds)) + 1, MAX_HISTORY_SAMPLES)
+
+def setupHistory():
+    # NOTE: a config reload redoes this, restarting every history
+    with rpi_values_lock:
+        rpi_history.clear()
+        if sample_interval_in_seconds == 0:
+            return
+        capacity = historyCapacity()
+        for collector in enabledCollectors():
+            for [key, field] in collector.fields.items():
+                if field.get('history'):
+                    rpi_history[key] = MetricHistory(capacity)
+    print_line('history of [{}] samples kept for {}', capacity, list(rpi_history.keys()), debug=True)
+
+def updateCollectorHistory(collector, oldKeys):
+    # after a collector's fields changed (hotplug): new fields get a history, those
+    #  gone lose theirs, the others keep theirs
+    # NOTE: caller holds rpi_values_lock
+    if sample_interval_in_seconds == 0:
+        return
+    for key in oldKeys:
+        if key not in collector.fields:
+            rpi_history.pop(key, None)
+    for [key, field] in collector.fields.items():
+        if field.get('history') and key not in rpi_history:
+            rpi_history[key] = MetricHistory(historyCapacity())
+
+def recordHistory(newValues):
+    # NOTE: caller holds rpi_values_lock
+    for [key, value] in newValues.items():
+        if key in rpi_history and isinstance(value, (int, float)):
+            rpi_history[key].add(value)
+
+def updateHistoryAggregates():
+    global rpi_values_generation
+    # close the window of each history, publishing its aggregates next to the value
+    with rpi_values_lock:
+        rpi_values_generation += 1
+        for [key, history] in rpi_history.items():
+            aggregates = history.aggregate()
+            if aggregates is None:
+                continue
+            for [name, value] in aggregates.items():
+                rpi_values[historyKey(key, name)] = round(value, 2)
+
+def isSampledCollector(collector):
+    if collector.cost != COST_CHEAP:
+        return False
+    for key in collector.fields:
+        if key in rpi_history:
+            return True
+    return False
 
+# -----------------------------------------------------------------------------
+#  Collector registry
+# -----------------------------------------------------------------------------
+#  A collector pairs one of the fetch routines above with a declaration of the
+#  fields it produces (payload name plus optional unit, device_class, icon,
+#  discovery sensor, history, adaptive deadband/threshold and whether it is
+#  exported over HTTP), how often it should be sampled and how costly it is.
+#  The registry drives sampling, the monitor payload and MQTT discovery.
+
+# sampling periods
+PERIOD_ONCE = -1            # static value, fetched once at startup
+PERIOD_EVERY_REPORT = 0     # fetched before every report
+                            # (any value > 0 is a minimum age in seconds)
+
+# cost classes, cheapest first
+COST_CHEAP = 'cheap'            # reads a few values from /proc or /sys
+COST_MODERATE = 'moderate'      # forks a small command
+COST_EXPENSIVE = 'expensive'    # forks pipelines or scans log files
+COST_CLASSES = [COST_CHEAP, COST_MODERATE, COST_EXPENSIVE]
+
+class Collector:
+    def __init__(self, name, fetch, fields, period=PERIOD_EVERY_REPORT, cost=COST_CHEAP, enabled=True, required=False):
+        self.name = name
+        self.fetch = fetch
+        self.fields = fields
+        self.period = period
+        self.cost = cost
+        self.enabled = enabled
+        self.enabled_by_default = enabled
+        self.required = required    # startup depends on it, can't be disabled
+        self.last_run = None
+        self.last_duration = 0.0
+
+    def isDue(self, now):
+        if self.last_run is None:
+            return True
+        if self.period == PERIOD_ONCE:
+            return False
+        return now - self.last_run >= self.period
+
+collectorRegistry = OrderedDict()
+
+def registerCollector(name, fetch, fields, **kwargs):
+    collectorRegistry[name] = Collector(name, fetch, OrderedDict(fields), **kwargs)
+
+def enabledCollectors():
+    return [collector for collector in collectorRegistry.values() if collector.enabled]
+
+def readCollectorSelection(config):
+    # per-node selection: [Collectors] max_cost = {class}, {collector name} = true|false
+    #  -> { collector name: enabled } as configured, raises ValueError describing the first bad setting
+    max_cost = config['Collectors'].get('max_cost', COST_EXPENSIVE).lower()
+    if max_cost not in COST_CLASSES:
+        raise ValueError('Invalid "max_cost" found in configuration file: "config.ini"! Must be one of {}'.format(COST_CLASSES))
+    selection = OrderedDict()
+    for collector in collectorRegistry.values():
+        enabled = collector.enabled_by_default and COST_CLASSES.index(collector.cost) <= COST_CLASSES.index(max_cost)
+        try:
+            selection[collector.name] = config['Collectors'].getboolean(collector.name, enabled)
+        except ValueError:
+            raise ValueError('Invalid "{}" found in [Collectors] section of configuration file: "config.ini"! Must be true or false'.format(collector.name))
+    return selection
+
+def applyCollectorSelection():
+    try:
+        selection = readCollectorSelection(config)
+    except ValueError as e:
+        print_line('ERROR: {} Fix and try again... Aborting', e, error=True, sd_notify=True)
+        sys.exit(1)
+    for collector in collectorRegistry.values():
+        enabled = selection[collector.name]
+        if not enabled and collector.required:
+            # (not when it is only above max_cost)
+            if collector.name in config['Collectors']:
+                print_line('Collector "{}" is required, ignoring request to disable it'.format(collector.name), warning=True)
+            enabled = True
+        collector.enabled = enabled
+        print_line('collector [{}] cost={}, period={}, enabled={}', collector.name, collector.cost, collector.period, collector.enabled, debug=True)
+
+# one run at a time: the report, sample and refresh timers all run collectors, and
+#  several keep state between runs (counter rates, the process table, dpkg.log offset)
+collectorRunLock = threading.RLock()
+
+def runCollectors(static_only=False, sampling=False, only=None):
+    # only: run just the named collectors, due or not
+    global rpi_values_generation
+    with collectorRunLock:
+        now = time()
+        for collector in enabledCollectors():
+            if only is not None:
+                if collector.name not in only:
+                    continue
+            elif static_only and collector.period != PERIOD_ONCE:
+                continue
+            elif sampling:
+                if not isSampledCollector(collector):
+                    continue
+            elif not collector.isDue(now):
+                continue
+            startTime = time()
+            try:
+                newValues = collector.fetch()
+            except Exception as e:
+                print_line('Collector "{}" failed: {}'.format(collector.name, e), error=True)
+                continue
+            collector.last_run = now
+            collector.last_duration = time() - startTime
+            with rpi_values_lock:
+                rpi_values.update(newValues)
+                recordHistory(newValues)
+                rpi_values_generation += 1
+            print_line('collector [{}] took {:.3f} sec', collector.name, collector.last_duration, debug=True)
+
+def buildMonitorData(timestamp):
+    rpiData = OrderedDict()
+    rpiData[SCRIPT_TIMESTAMP] = timestamp.astimezone().replace(microsecond=0).isoformat()
+    with rpi_values_lock:
+        for collector in enabledCollectors():
+            for key in collector.fields:
+                if key in rpi_values:
+                    rpiData[key] = rpi_values[key]
+                if key in rpi_history:
+                    for aggregate in HISTORY_AGGREGATES:
+                        if historyKey(key, aggregate) in rpi_values:
+                            rpiData[historyKey(key, aggregate)] = rpi_values[historyKey(key, aggregate)]
+    return rpiData
+
+registerCollector('model', getDeviceModel, [
+        (RPI_MODEL, dict()),
+        (RPI_CONNECTIONS, dict()),
+    ], period=PERIOD_ONCE, required=True)
+registerCollector('hostnames', getHostnames, [
+        (RPI_HOSTNAME, dict()),
+        (RPI_FQDN, dict()),
+    ], period=PERIOD_ONCE, cost=COST_MODERATE, required=True)
+registerCollector('os_release', getLinuxRelease, [
+        (RPI_LINUX_RELEASE, dict()),
+    ], period=PERIOD_ONCE, required=True)
+registerCollector('os_version', getLinuxVersion, [
+        (RPI_LINUX_VERSION, dict()),
+    ], period=PERIOD_ONCE, required=True)
+registerCollector('uptime', getUptimeAndLoad, [
+        (RPI_UPTIME, dict(exported=False)),
+        (RPI_LOAD_1M, dict(deadband=0.5)),
+        (RPI_LOAD_5M, dict()),
+        (RPI_LOAD_15M, dict()),
+    ])
+registerCollector('apt_update', getLastUpdateDate, [
+        (RPI_DATE_LAST_UPDATE, dict(device_class='timestamp')),
+    ])
+# only reads what was appended to dpkg.log since the last report
+registerCollector('dpkg_install', getLastInstallDate, [
+        (RPI_DATE_LAST_INSTALL, dict(device_class='timestamp')),
+    ])
+# parses apt's package lists when they change so off unless asked for
+registerCollector('apt_pending', getPendingUpgrades, [
+        (RPI_UPGRADES_PENDING, dict(sensor='upgrades', title='Upgrades', icon='mdi:package-up')),
+        (RPI_SECURITY_UPGRADES_PENDING, dict()),
+    ], period=60 * 60, cost=COST_EXPENSIVE, enabled=False)
+registerCollector('filesystem', getFileSystemDrives, [
+        (RPI_FS_SPACE, dict(unit='GB')),
+        (RPI_FS_AVAIL, dict(unit='%', sensor='disk_used', title='Used', icon='mdi:sd', deadband=1, threshold=90)),
+    ], cost=COST_MODERATE)
+registerCollector('memory', getDeviceMemory, [
+        (RPI_MEM_TOTAL, dict(unit='MB')),
+        (RPI_MEM_AVAIL, dict(unit='MB', history=True, deadband=50)),
+        (RPI_MEM_FREE, dict(unit='MB', history=True)),
+        (RPI_MEM_BUFFERS, dict(unit='MB', history=True)),
+        (RPI_MEM_CACHED, dict(unit='MB', history=True)),
+        (RPI_MEM_DIRTY, dict(unit='MB', history=True)),
+        (RPI_MEM_WRITEBACK, dict(unit='MB', history=True)),
+        (RPI_SWAP_TOTAL, dict(unit='MB')),
+        (RPI_SWAP_FREE, dict(unit='MB', history=True)),
+        (RPI_ZRAM_STORED, dict(unit='MB', history=True)),
+        (RPI_ZRAM_USED, dict(unit='MB', history=True)),
+    ])
+registerCollector('pressure', getPressureStall, [
+        (RPI_PSI_CPU_SOME, dict(unit='%')),
+        (RPI_PSI_MEM_SOME, dict(unit='%')),
+        (RPI_PSI_MEM_FULL, dict(unit='%')),
+        (RPI_PSI_IO_SOME, dict(unit='%')),
+        (RPI_PSI_IO_FULL, dict(unit='%')),
+    ])
+registerCollector('paging', getPagingActivity, [
+        (RPI_MAJOR_FAULTS, dict(unit='/s')),
+        (RPI_SWAP_IN, dict(unit='pages/s')),
+        (RPI_SWAP_OUT, dict(unit='pages/s')),
+    ])
+# reads every /proc/[pid]/stat so off unless asked for
+registerCollector('processes', getTopProcesses, [
+        (RPI_PROCESS_COUNT, dict()),
+        (RPI_PROCESS_SCAN_MS, dict(unit='ms')),
+        (RPI_TOP_CPU, dict(exported=False)),
+        (RPI_TOP_RSS, dict(exported=False)),
+    ], cost=COST_MODERATE, enabled=False)
+registerCollector('cpu', getDeviceCpuInfo, [
+        (RPI_CPU_VENDOR, dict()),
+        (RPI_CPU_MODEL, dict()),
+        (RPI_CPU_ARCHITECTURE, dict()),
+        (RPI_CPU_BOGOMIPS, dict()),
+        (RPI_CPU_CORES, dict()),
+    ], period=PERIOD_ONCE, cost=COST_MODERATE)
+registerCollector('temperature', getSystemTemperature, [
+        (RPI_CPU_TEMP, dict(unit='°C', device_class='temperature', sensor='temperature', title='Temperature', icon='mdi:thermometer', history=True, deadband=2.0, threshold=70.0)),
+    ])
+# only on by default where there is a wireless interface
+registerCollector('wireless', getWirelessQuality, [
+        (RPI_WIFI_INTERFACE, dict()),
+        (RPI_WIFI_LINK_QUALITY, dict(sensor='wifi_link_quality', title='WiFi Link Quality', icon='mdi:wifi')),
+        (RPI_WIFI_SIGNAL_LEVEL, dict(unit='dBm', device_class='signal_strength', sensor='wifi_signal', title='WiFi Signal', icon='mdi:wifi', deadband=5)),
+        (RPI_WIFI_NOISE_LEVEL, dict(unit='dBm')),
+        (RPI_WIFI_DISCARDED_RETRY, dict(unit='/s')),
+        (RPI_WIFI_MISSED_BEACON, dict(unit='/s')),
+    ], enabled=hasWirelessInterface())
+# bitrates and retries need iw (forked) so off unless asked for
+registerCollector('wireless_link', getWirelessLink, [
+        (RPI_WIFI_TX_BITRATE, dict(unit='Mbit/s', sensor='wifi_tx_bitrate', title='WiFi Tx Bitrate', icon='mdi:speedometer')),
+        (RPI_WIFI_RX_BITRATE, dict(unit='Mbit/s')),
+        (RPI_WIFI_TX_RETRIES, dict(unit='/s')),
+        (RPI_WIFI_TX_FAILED, dict(unit='/s')),
+    ], cost=COST_MODERATE, enabled=False)
+# every thermal zone and hwmon temperature, each its own entity (fields follow the sources found)
+temperatureSources.hasChanged()
+temperatureSources.scan()
+registerCollector('thermal', getTemperatureSweep, temperatureFields(), enabled=False)
+registerCollector('reporter', getReporterInfo, [
+        (RPI_SCRIPT, dict()),
+        (SCRIPT_REPORT_INTERVAL, dict(unit='min')),
+    ], required=True)
+
+applyCollectorSelection()
+if corpus_dir:
+    # a corpus covers every collector, whatever this node's [Collectors] says
+    for collector in collectorRegistry.values():
+        collector.enabled = True
+setupHistory()
+
+# get our hostnames so we can setup MQTT (and model so we can use it too in MQTT)
+runCollectors(static_only=True)
+rpi_hostname = getValue(RPI_HOSTNAME)
+rpi_fqdn = getValue(RPI_FQDN)
+
+def resolveSensorName():
+    global sensor_name
+    if(sensor_name == default_sensor_name):
+        sensor_name = 'rpi-{}'.format(rpi_hostname)
+
+resolveSensorName()
 
-# get our hostnames so we can setup MQTT
-getHostnames()
-if(sensor_name == default_sensor_name):
-    sensor_name = 'rpi-{}'.format(rpi_hostname)
-# get model so we can use it too in MQTT
-getDeviceModel()
-getDeviceCpuInfo()
-getLinuxRelease()
-getLinuxVersion()
-getFileSystemDrives()
+# -----------------------------------------------------------------------------
+#  corpus record / replay (--record DIR, --replay DIR)
+# -----------------------------------------------------------------------------
+#  The static collectors have run above, this runs the others once and builds
+#  the payload.  --record saves it with the corpus, --replay compares it with
+#  the recorded one (leaving out the values that depend on when and how fast it
+#  ran) and, given -b N, goes on to time N cycles over the corpus.
+
+# differ from run to run (or with the script version)
+CORPUS_VOLATILE_FIELDS = [SCRIPT_TIMESTAMP, RPI_PROCESS_SCAN_MS, RPI_SCRIPT]
+# the settings a payload depends on, kept with the corpus (not the [MQTT] credentials)
+CORPUS_CONFIG_SECTIONS = ['Daemon', 'Collectors']
+
+def corpusPayload():
+    runCollectors()
+    payload = buildMonitorData(datetime.now(local_tz))
+    # as published: what json makes of our values
+    return json.loads(json.dumps(OrderedDict((key, value) for [key, value] in payload.items() if key not in CORPUS_VOLATILE_FIELDS)), object_pairs_hook=OrderedDict)
+
+def recordCorpusConfig():
+    corpusConfig = ConfigParser(delimiters=('=', ))
+    corpusConfig.optionxform = str
+    for section in CORPUS_CONFIG_SECTIONS:
+        corpusConfig[section] = dict((name, value) for [name, value] in config[section].items() if name != 'fs_root')
+    corpusConfig['MQTT'] = dict(sensor_name=sensor_name)
+    with open(os.path.join(opt_record, 'config.ini'), 'w') as configFile:
+        corpusConfig.write(configFile)
+
+def recordCorpus():
+    payload = corpusPayload()
+    recordCorpusConfig()
+    with open(os.path.join(opt_record, CORPUS_COMMANDS_FILE), 'w') as commandsFile:
+        json.dump(corpus_commands, commandsFile, indent=2)
+    with open(os.path.join(opt_record, CORPUS_SYSCONF_FILE), 'w') as sysconfFile:
+        json.dump(corpus_sysconf, sysconfFile, indent=2)
+    with open(os.path.join(opt_record, CORPUS_PAYLOAD_FILE), 'w') as payloadFile:
+        json.dump(payload, payloadFile, indent=2)
+    fileCount = sum(len(names) for [_, _, names] in os.walk(os.path.join(opt_record, CORPUS_ROOT_DIR)))
+    print_line('Recorded {} files, {} commands and {} values in corpus "{}"'.format(fileCount, len(corpus_commands), len(payload), opt_record))
+
+def replayCorpus():
+    try:
+        with open(os.path.join(opt_replay, CORPUS_PAYLOAD_FILE)) as payloadFile:
+            recorded = json.load(payloadFile, object_pairs_hook=OrderedDict)
+    except (OSError, ValueError) as e:
+        print_line('ERROR: can\'t load corpus "{}": {}... Aborting', opt_replay, e, error=True)
+        sys.exit(1)
+    payload = corpusPayload()
+    keys = list(OrderedDict.fromkeys(list(recorded.keys()) + list(payload.keys())))
+    mismatches = [key for key in keys if recorded.get(key) != payload.get(key)]
+    for key in mismatches:
+        print_line('Replay: "{}" is {}, recorded {}'.format(key, json.dumps(payload.get(key)), json.dumps(recorded.get(key))), warning=True)
+    print_line('Replayed corpus "{}": {} of {} values match'.format(opt_replay, len(keys) - len(mismatches), len(keys)))
+    return len(mismatches) == 0
+
+if opt_record:
+    recordCorpus()
+    sys.exit(0)
+if opt_replay:
+    replayMatched = replayCorpus()
+    if opt_benchmark == 0:
+        sys.exit(0 if replayMatched else 1)
+
+# -----------------------------------------------------------------------------
+#  collection cycle benchmark (-b N)
+# -----------------------------------------------------------------------------
+#  Times N report cycles - collectors, history aggregates, payload and its log
+#  line - with the log level quiet, verbose and debug.  Output goes to /dev/null
+#  so the numbers are what formatting (not the terminal) costs.
+
+def benchmarkCollectionCycle(cycles):
+    global opt_verbose
+    global opt_debug
+    results = []
+    savedLevel = (opt_verbose, opt_debug)
+    savedStreams = (sys.stdout, sys.stderr)
+    with open(os.devnull, 'w') as devnull:
+        for [levelName, verbose, debug] in [('quiet', False, False), ('verbose', True, False), ('debug', True, True)]:
+            opt_verbose, opt_debug = verbose, debug
+            sys.stdout = sys.stderr = devnull
+            try:
+                durations = []
+                for _ in range(cycles):
+                    startTime = monotonic()
+                    runCollectors()
+                    updateHistoryAggregates()
+                    payload = json.dumps(OrderedDict([('info', buildMonitorData(datetime.now(local_tz)))]))
+                    print_line('Publishing to MQTT topic "{}, Data:{}"', 'benchmark', payload)
+                    durations.append(monotonic() - startTime)
+                    for collector in collectorRegistry.values():
+                        if collector.period != PERIOD_ONCE:
+                            collector.last_run = None     # due again next cycle
+            finally:
+                sys.stdout, sys.stderr = savedStreams
+            results.append((levelName, durations))
+    opt_verbose, opt_debug = savedLevel
+    for [levelName, durations] in results:
+        durations.sort()
+        print_line('benchmark {:8s} {} cycles: mean {:.2f} ms, median {:.2f} ms, max {:.2f} ms', levelName, cycles,
+            sum(durations) * 1000.0 / cycles, durations[cycles // 2] * 1000.0, durations[-1] * 1000.0)
+
+if opt_benchmark > 0:
+    benchmarkCollectionCycle(opt_benchmark)
+    sys.exit(0)
+
+# -----------------------------------------------------------------------------
+#  HTTP metrics endpoint (OpenMetrics / Prometheus)
+# -----------------------------------------------------------------------------
+#  Serves the latest collected values from rpi_values - a scrape never runs a
+#  collector, so MQTT and Prometheus share the one set of collectors.  The text
+#  is rendered once per change of the values and reused by the scrapes between.
+
+METRICS_PREFIX = 'rpi_'
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+metrics_cache_lock = threading.Lock()
+metrics_cache = {}     # { openmetrics: bool } -> (generation, body)
+
+def metricName(key):
+    return METRICS_PREFIX + re.sub('[^a-zA-Z0-9_]', '_', key)
+
+def escapeLabelValue(value):
+    return '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def timestampToSeconds(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def renderMetrics(openmetrics):
+    hostLabel = 'host="{}"'.format(escapeLabelValue(rpi_hostname))
+    lines = []
+    infoLabels = [hostLabel]
+    with rpi_values_lock:
+        for collector in enabledCollectors():
+            for [key, field] in collector.fields.items():
+                if not field.get('exported', True):
+                    continue
+                keys = [key]
+                if key in rpi_history:
+                    keys += [historyKey(key, aggregate) for aggregate in HISTORY_AGGREGATES]
+                for valueKey in keys:
+                    if valueKey not in rpi_values:
+                        continue
+                    value = rpi_values[valueKey]
+                    name = metricName(valueKey)
+                    if field.get('device_class') == 'timestamp':
+                        value = timestampToSeconds(value)
+                        name = '{}_timestamp_seconds'.format(name)
+                    elif isinstance(value, bool) or not isinstance(value, (int, float)):
+                        infoLabels.append('{}="{}"'.format(metricName(valueKey)[len(METRICS_PREFIX):], escapeLabelValue(value)))
+                        continue
+                    if value is None:
+                        continue
+                    if 'unit' in field:
+                        lines.append('# HELP {} {} [{}]'.format(name, valueKey, field['unit']))
+                    lines.append('# TYPE {} gauge'.format(name))
+                    lines.append('{}{{{}}} {}'.format(name, hostLabel, value))
+    if openmetrics:
+        lines.append('# TYPE {}device info'.format(METRICS_PREFIX))
+        lines.append('{}device_info{{{}}} 1'.format(METRICS_PREFIX, ','.join(infoLabels)))
+        lines.append('# EOF')
+    else:
+        lines.append('# TYPE {}device_info gauge'.format(METRICS_PREFIX))
+        lines.append('{}device_info{{{}}} 1'.format(METRICS_PREFIX, ','.join(infoLabels)))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def getMetricsBody(openmetrics):
+    with metrics_cache_lock:
+        cached = metrics_cache.get(openmetrics)
+        if cached is None or cached[0] != rpi_values_generation:
+            cached = (rpi_values_generation, renderMetrics(openmetrics))
+            metrics_cache[openmetrics] = cached
+        return cached[1]
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+        body = getMetricsBody(openmetrics)
+        self.send_response(200)
+        self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if opt_debug:   # the request line is %-formatted, only for a line that gets printed
+            print_line('HTTP {} - {}', self.address_string(), format % args, debug=True)
+
+def startMetricsServer():
+    try:
+        server = ThreadingHTTPServer((http_bind_address, http_port), MetricsRequestHandler)
+    except OSError as e:
+        print_line('HTTP metrics endpoint failed to start on {}:{} - {}'.format(http_bind_address, http_port, e), error=True, sd_notify=True)
+        return None
+    server.daemon_threads = True
+    serverThread = threading.Thread(target=server.serve_forever, name='http-metrics')
+    serverThread.daemon = True
+    serverThread.start()
+    print_line('Serving metrics on http://{}:{}/metrics', http_bind_address, http_port, verbose=True)
+    return server
+
+def restartMetricsServer():
+    # (re)start the endpoint as [HTTP] says, stopping the one running
+    global metrics_server
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+        metrics_server = None
+    if http_enabled:
+        metrics_server = startMetricsServer()
+
+metrics_server = None
+restartMetricsServer()
 
 # -----------------------------------------------------------------------------
 #  timer and timer funcs for ALIVE MQTT Notices handling
@@ -620,7 +2273,7 @@ ALIVE_TIMOUT_IN_SECONDS = 60
 
 def publishAliveStatus():
     print_line('- SEND: yes, still alive -', debug=True)
-    mqtt_client.publish(lwt_topic, payload=lwt_online_val, retain=False)
+    publishMQTT(lwt_topic, lwt_online_val, alias=True, expire=True)
 
 def aliveTimeoutHandler():
     print_line('- MQTT TIMER INTERRUPT -', debug=True)
@@ -634,7 +2287,7 @@ def startAliveTimer():
     aliveTimer = threading.Timer(ALIVE_TIMOUT_IN_SECONDS, aliveTimeoutHandler)
     aliveTimer.start()
     aliveTimerRunningStatus = True
-    print_line('- started MQTT timer - every {} seconds'.format(ALIVE_TIMOUT_IN_SECONDS), debug=True)
+    print_line('- started MQTT timer - every {} seconds', ALIVE_TIMOUT_IN_SECONDS, debug=True)
 
 def stopAliveTimer():
     global aliveTimer
@@ -658,52 +2311,183 @@ aliveTimerRunningStatus = False
 #  MQTT setup and startup
 # -----------------------------------------------------------------------------
 
-# MQTT connection
-lwt_topic = '{}/sensor/{}/status'.format(base_topic, sensor_name.lower())
-lwt_online_val = 'online'
-lwt_offline_val = 'offline'
-
-print_line('Connecting to MQTT broker ...', verbose=True)
-mqtt_client = mqtt.Client()
-mqtt_client.on_connect = on_connect
-mqtt_client.on_publish = on_publish
+# our RPi Reporter device
+LD_MONITOR = "monitor" # KeyError: 'home310/sensor/rpi-pi3plus/values' let's not use this 'values' as topic
+LDS_PAYLOAD_NAME = "info"
 
+def sensorBaseTopic(sensorName):
+    return '{}/sensor/{}'.format(mqtt_base_topic, sensorName.lower())
 
+def setupTopics():
+    # NOTE: redone when a reload changes base_topic or sensor_name
+    global base_topic
+    global values_topic
+    global activity_topic
+    global lwt_topic
+    global command_topic
+    base_topic = sensorBaseTopic(sensor_name)
+    values_topic = '{}/{}'.format(base_topic, LD_MONITOR)
+    activity_topic = '{}/status'.format(base_topic)    # vs. LWT
+    lwt_topic = activity_topic
+    command_topic = '{}/set'.format(base_topic)
 
-mqtt_client.will_set(lwt_topic, payload=lwt_offline_val, retain=True)
+setupTopics()
 
-if config['MQTT'].getboolean('tls', False):
-    # According to the docs, setting PROTOCOL_SSLv23 "Selects the highest protocol version
-    # that both the client and server support. Despite the name, this option can select
-    # “TLS” protocols as well as “SSL”" - so this seems like a resonable default
-    mqtt_client.tls_set(
-        ca_certs=config['MQTT'].get('tls_ca_cert', None),
-        keyfile=config['MQTT'].get('tls_keyfile', None),
-        certfile=config['MQTT'].get('tls_certfile', None),
-        tls_version=ssl.PROTOCOL_SSLv23
-    )
+# MQTT connection
+lwt_online_val = 'online'
+lwt_offline_val = 'offline'
 
-mqtt_username = os.environ.get("MQTT_USERNAME", config['MQTT'].get('username'))
-mqtt_password = os.environ.get("MQTT_PASSWORD", config['MQTT'].get('password', None))
+# MQTT v5: topic aliases, message expiry and session resumption (opt-in)
+#  Aliases are per connection: the first publish to a topic sends the full topic
+#  plus a new alias, later ones send only the alias (an empty topic).  We count the
+#  exact PUBLISH packet sizes so the savings can be checked against a broker.
+
+class TopicAliases:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.maximum = 0
+        self.aliases = {}
+
+    def reset(self, maximum):
+        with self.lock:
+            self.maximum = maximum
+            self.aliases = {}
+
+    def lookup(self, topic):
+        # returns (alias, alreadyEstablished) - alias is 0 when none is available
+        with self.lock:
+            if topic in self.aliases:
+                return self.aliases[topic], True
+            if len(self.aliases) >= self.maximum:
+                return 0, False
+            alias = len(self.aliases) + 1
+            self.aliases[topic] = alias
+            return alias, False
+
+mqtt_topic_aliases = TopicAliases()
+mqtt_session_present = False
+mqtt_stats_lock = threading.Lock()
+mqtt_stats = OrderedDict([('publishes', 0), ('bytes', 0), ('bytes_without_aliases', 0)])
+
+def remainingLengthSize(length):
+    size = 1
+    while length > 127:
+        length //= 128
+        size += 1
+    return size
+
+def publishPacketSize(topic, payload, qos, properties):
+    # bytes on the wire for one PUBLISH packet
+    length = 2 + len(topic.encode('utf-8')) + len(payload)
+    if qos > 0:
+        length += 2
+    if mqtt_protocol_v5:
+        length += len(properties.pack()) if properties is not None else 1
+    return 1 + remainingLengthSize(length) + length
+
+def messageExpiry(intervalInMinutes):
+    # seconds a message expires after, the default follows the interval (adaptive reporting moves it)
+    if message_expiry_in_seconds is not None:
+        return message_expiry_in_seconds
+    return 2 * intervalInMinutes * 60
+
+def publishMQTT(topic, payload, qos=0, retain=False, alias=False, expire=False, intervalInMinutes=None):
+    # NOTE: every publish goes through here so v5 properties are applied consistently
+    #  (intervalInMinutes: the report interval of the host published for, Default: ours)
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    properties = None
+    sentTopic = topic
+    aliasBytes = 0
+    if mqtt_protocol_v5:
+        properties = Properties(PacketTypes.PUBLISH)
+        expiry = messageExpiry(effective_interval_in_minutes if intervalInMinutes is None else intervalInMinutes) if expire else 0
+        if expiry > 0:
+            properties.MessageExpiryInterval = int(expiry)
+        # only alias QoS 0 publishes while connected: paho resends unacknowledged QoS 1/2
+        #  publishes as they were on a new connection, where their alias is unknown
+        if alias and qos == 0 and mqtt_topic_aliases.maximum > 0 and mqtt_client.is_connected():
+            topicAlias, established = mqtt_topic_aliases.lookup(topic)
+            if topicAlias > 0:
+                properties.TopicAlias = topicAlias
+                aliasBytes = 3
+                if established:
+                    sentTopic = ''
+    result = mqtt_client.publish(sentTopic, payload, qos, retain=retain, properties=properties) if mqtt_protocol_v5 else mqtt_client.publish(topic, payload, qos, retain=retain)
+    with mqtt_stats_lock:
+        mqtt_stats['publishes'] += 1
+        mqtt_stats['bytes'] += publishPacketSize(sentTopic, payload, qos, properties)
+        mqtt_stats['bytes_without_aliases'] += publishPacketSize(topic, payload, qos, properties) - aliasBytes
+    return result
+
+def logMQTTStats():
+    with mqtt_stats_lock:
+        saved = mqtt_stats['bytes_without_aliases'] - mqtt_stats['bytes']
+        print_line('MQTT: {} publishes, {} bytes sent, {} bytes saved by topic aliases', mqtt_stats['publishes'], mqtt_stats['bytes'], saved, verbose=True)
+
+def mqttClientID():
+    # v5: a stable client id lets the broker resume our session (3.1.1: paho picks a random one)
+    return 'rpi-reporter-{}'.format(sensor_name.lower()) if mqtt_protocol_v5 else ''
+
+def newMQTTClient():
+    # a client set up as the running settings say, not yet connected
+    if mqtt_protocol_v5:
+        client = mqtt.Client(client_id=mqttClientID(), protocol=mqtt.MQTTv5)
+    else:
+        client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_publish = on_publish
+    client.on_message = on_message
+
+    client.will_set(lwt_topic, payload=lwt_offline_val, retain=True)
+
+    if mqtt_tls:
+        # According to the docs, setting PROTOCOL_SSLv23 "Selects the highest protocol version
+        # that both the client and server support. Despite the name, this option can select
+        # “TLS” protocols as well as “SSL”" - so this seems like a resonable default
+        client.tls_set(
+            ca_certs=mqtt_tls_ca_cert,
+            keyfile=mqtt_tls_keyfile,
+            certfile=mqtt_tls_certfile,
+            tls_version=ssl.PROTOCOL_SSLv23
+        )
+
+    if mqtt_username:
+        client.username_pw_set(mqtt_username, mqtt_password)
+    return client
+
+def connectMQTTClient(client, cleanStart=False):
+    connectArgs = {}
+    if mqtt_protocol_v5:
+        connectProperties = Properties(PacketTypes.CONNECT)
+        connectProperties.SessionExpiryInterval = session_expiry_in_seconds
+        # (a clean start only the first time, paho's reconnects resume the session)
+        connectArgs = dict(clean_start=mqtt.MQTT_CLEAN_START_FIRST_ONLY if cleanStart else False, properties=connectProperties)
+    client.connect(mqtt_hostname, port=mqtt_port, keepalive=mqtt_keepalive, **connectArgs)
+
+def connectMQTT():
+    global mqtt_client
+    print_line('Connecting to MQTT broker ...', verbose=True)
+    try:
+        mqtt_client = newMQTTClient()
+        connectMQTTClient(mqtt_client)
+    except:
+        print_line('MQTT connection error. Please check your settings in the configuration file "config.ini"', error=True, sd_notify=True)
+        sys.exit(1)
+    else:
+        publishMQTT(lwt_topic, lwt_online_val)
+        mqtt_client.loop_start()
 
-if mqtt_username:
-    mqtt_client.username_pw_set(mqtt_username, mqtt_password)
-try:
-    mqtt_client.connect(os.environ.get('MQTT_HOSTNAME', config['MQTT'].get('hostname', 'localhost')),
-                        port=int(os.environ.get('MQTT_PORT', config['MQTT'].get('port', '1883'))),
-                        keepalive=config['MQTT'].getint('keepalive', 60))
-except:
-    print_line('MQTT connection error. Please check your settings in the configuration file "config.ini"', error=True, sd_notify=True)
-    sys.exit(1)
-else:
-    mqtt_client.publish(lwt_topic, payload=lwt_online_val, retain=False)
-    mqtt_client.loop_start()
+        while mqtt_client_connected == False: #wait in loop
+            print_line('* Wait on mqtt_client_connected=[{}]', mqtt_client_connected, debug=True)
+            sleep(1.0) # some slack to establish the connection
 
-    while mqtt_client_connected == False: #wait in loop
-        print_line('* Wait on mqtt_client_connected=[{}]'.format(mqtt_client_connected), debug=True)
-        sleep(1.0) # some slack to establish the connection
+        startAliveTimer()
 
-    startAliveTimer()
+# agents hand their reports to the relay, they never connect to the broker
+mqtt_client = None
+if relay_mode != RELAY_MODE_AGENT:
+    connectMQTT()
 
 sd_notifier.notify('READY=1')
 
@@ -714,77 +2498,230 @@ sd_notifier.notify('READY=1')
 
 # what RPi device are we on?
 # get our hostnames so we can setup MQTT
-loadNetworkIFMAC() # this will fill-in rpi_mac
+rpi_mac = loadNetworkIFMAC()
 
 mac_basic = rpi_mac.lower().replace(":", "")
 mac_left = mac_basic[:6]
 mac_right = mac_basic[6:]
-print_line('mac lt=[{}], rt=[{}], mac=[{}]'.format(mac_left, mac_right, mac_basic), debug=True)
+print_line('mac lt=[{}], rt=[{}], mac=[{}]', mac_left, mac_right, mac_basic, debug=True)
 uniqID = "RPi-{}Mon{}".format(mac_left, mac_right)
-
-# our RPi Reporter device
-LD_MONITOR = "monitor" # KeyError: 'home310/sensor/rpi-pi3plus/values' let's not use this 'values' as topic
-LD_SYS_TEMP= "temperature"
-LD_FS_USED = "disk_used"
-LDS_PAYLOAD_NAME = "info"
+if instance_id:
+    # another daemon on this machine (e.g. agents and relay on one host)
+    uniqID = '{}-{}'.format(uniqID, instance_id)
 
 # Publish our MQTT auto discovery
-#  table of key items to publish:
-detectorValues = OrderedDict([
-    (LD_MONITOR, dict(title="RPi Monitor {}".format(rpi_hostname), device_class="timestamp", no_title_prefix="yes", json_value="timestamp", json_attr="yes", icon='mdi:raspberry-pi', device_ident="RPi-{}".format(rpi_fqdn))),
-    (LD_SYS_TEMP, dict(title="RPi Temperature {}".format(rpi_hostname), device_class="temperature", no_title_prefix="yes", unit="°C", json_value="cpu_temperature", icon='mdi:thermometer')),
-    (LD_FS_USED, dict(title="RPi Used {}".format(rpi_hostname), no_title_prefix="yes", json_value="root_fs_used_percent", unit="%", icon='mdi:sd')),
-])
+#  table of key items to publish: our monitor plus each collector field declaring a sensor
+def buildDetectorValues():
+    detectorValues = OrderedDict([
+        (LD_MONITOR, dict(title="RPi Monitor {}".format(rpi_hostname), device_class="timestamp", no_title_prefix="yes", json_value="timestamp", json_attr="yes", icon='mdi:raspberry-pi', device_ident="RPi-{}".format(rpi_fqdn))),
+    ])
+    for collector in enabledCollectors():
+        for [key, field] in collector.fields.items():
+            if 'sensor' not in field:
+                continue
+            params = dict(title="RPi {} {}".format(field['title'], rpi_hostname), no_title_prefix="yes", json_value=key)
+            if 'device_class' in field:
+                params['device_class'] = field['device_class']
+            if 'unit' in field:
+                params['unit'] = field['unit']
+            if 'icon' in field:
+                params['icon'] = field['icon']
+            detectorValues[field['sensor']] = params
+            if announce_history_sensors and key in rpi_history:
+                for aggregate in HISTORY_AGGREGATES:
+                    aggregateParams = dict(params)
+                    aggregateParams['title'] = "RPi {} {} {}".format(field['title'], aggregate.title(), rpi_hostname)
+                    aggregateParams['json_value'] = historyKey(key, aggregate)
+                    detectorValues[historyKey(field['sensor'], aggregate)] = aggregateParams
+    return detectorValues
 
-print_line('Announcing RPi Monitoring device to MQTT broker for auto-discovery ...')
-
-base_topic = '{}/sensor/{}'.format(base_topic, sensor_name.lower())
 values_topic_rel = '{}/{}'.format('~', LD_MONITOR)
-values_topic = '{}/{}'.format(base_topic, LD_MONITOR)
 activity_topic_rel = '{}/status'.format('~')     # vs. LWT
-activity_topic = '{}/status'.format(base_topic)    # vs. LWT
 
 command_topic_rel = '~/set'
 
-for [sensor, params] in detectorValues.items():
-    discovery_topic = '{}/sensor/{}/{}/config'.format(discovery_prefix, sensor_name.lower(), sensor)
-    payload = OrderedDict()
-    if 'no_title_prefix' in params:
-        payload['name'] = "{}".format(params['title'].title())
-    else:
-        payload['name'] = "{} {}".format(sensor_name.title(), params['title'].title())
-    payload['uniq_id'] = "{}_{}".format(uniqID, sensor.lower())
-    if 'device_class' in params:
-        payload['dev_cla'] = params['device_class']
-    if 'unit' in params:
-        payload['unit_of_measurement'] = params['unit']
-    if 'json_value' in params:
-        payload['stat_t'] = values_topic_rel
-        payload['val_tpl'] = "{{{{ value_json.{}.{} }}}}".format(LDS_PAYLOAD_NAME, params['json_value'])
-    payload['~'] = base_topic
-    payload['pl_avail'] = lwt_online_val
-    payload['pl_not_avail'] = lwt_offline_val
-    if 'icon' in params:
-        payload['ic'] = params['icon']
-    payload['avty_t'] = activity_topic_rel
-    if 'json_attr' in params:
-        payload['json_attr_t'] = values_topic_rel
-        payload['json_attr_tpl'] = '{{{{ value_json.{} | tojson }}}}'.format(LDS_PAYLOAD_NAME)
-    if 'device_ident' in params:
-        payload['dev'] = {
-                'identifiers' : ["{}".format(uniqID)],
-                'manufacturer' : 'Raspberry Pi (Trading) Ltd.',
-                'name' : params['device_ident'],
-                'model' : '{}'.format(rpi_model),
-                'sw_version': "{} {}".format(rpi_linux_release, rpi_linux_version)
-        }
-    else:
-         payload['dev'] = {
-                'identifiers' : ["{}".format(uniqID)],
-         }
-    mqtt_client.publish(discovery_topic, json.dumps(payload), 1, retain=True)
+def hostIdentity():
+    identity = OrderedDict()
+    identity['sensor_name'] = sensor_name
+    identity['uniq_id'] = uniqID
+    identity['model'] = getValue(RPI_MODEL)
+    identity['sw_version'] = "{} {}".format(getValue(RPI_LINUX_RELEASE), getValue(RPI_LINUX_VERSION))
+    return identity
+
+def buildDiscoveryMessages(identity, detectorValues, relayed=False):
+    # { discovery config topic: payload } for one host (an agent of ours when relayed)
+    messages = OrderedDict()
+    hostSensorName = identity['sensor_name']
+    hostUniqID = identity['uniq_id']
+    for [sensor, params] in detectorValues.items():
+        discovery_topic = '{}/sensor/{}/{}/config'.format(discovery_prefix, hostSensorName.lower(), sensor)
+        payload = OrderedDict()
+        if 'no_title_prefix' in params:
+            payload['name'] = "{}".format(params['title'].title())
+        else:
+            payload['name'] = "{} {}".format(hostSensorName.title(), params['title'].title())
+        payload['uniq_id'] = "{}_{}".format(hostUniqID, sensor.lower())
+        if 'device_class' in params:
+            payload['dev_cla'] = params['device_class']
+        if 'unit' in params:
+            payload['unit_of_measurement'] = params['unit']
+        if 'json_value' in params:
+            payload['stat_t'] = values_topic_rel
+            payload['val_tpl'] = "{{{{ value_json.{}.{} }}}}".format(LDS_PAYLOAD_NAME, params['json_value'])
+        payload['~'] = sensorBaseTopic(hostSensorName)
+        payload['pl_avail'] = lwt_online_val
+        payload['pl_not_avail'] = lwt_offline_val
+        if 'icon' in params:
+            payload['ic'] = params['icon']
+        if relayed:
+            # the agent's status is ours to publish, it is only known while we're online
+            payload['avty'] = [
+                    { 't': activity_topic_rel, 'pl_avail': lwt_online_val, 'pl_not_avail': lwt_offline_val },
+                    { 't': lwt_topic, 'pl_avail': lwt_online_val, 'pl_not_avail': lwt_offline_val },
+            ]
+            payload['avty_mode'] = 'all'
+        else:
+            payload['avty_t'] = activity_topic_rel
+        if 'json_attr' in params:
+            payload['json_attr_t'] = values_topic_rel
+            payload['json_attr_tpl'] = '{{{{ value_json.{} | tojson }}}}'.format(LDS_PAYLOAD_NAME)
+        if 'device_ident' in params:
+            payload['dev'] = {
+                    'identifiers' : ["{}".format(hostUniqID)],
+                    'manufacturer' : 'Raspberry Pi (Trading) Ltd.',
+                    'name' : params['device_ident'],
+                    'model' : '{}'.format(identity['model']),
+                    'sw_version': identity['sw_version']
+            }
+        else:
+             payload['dev'] = {
+                    'identifiers' : ["{}".format(hostUniqID)],
+             }
+        messages[discovery_topic] = json.dumps(payload)
+
+        # remove connections as test:                  'connections' : [["mac", mac.lower()], [interface, ipaddr]],
+    return messages
+
+def publishDiscovery(identity, detectorValues, relayed=False):
+    # NOTE: also used by the relay to announce its agents
+    for [discovery_topic, payload] in buildDiscoveryMessages(identity, detectorValues, relayed).items():
+        publishMQTT(discovery_topic, payload, 1, retain=True)
+
+def ownDiscoveryMessages():
+    return buildDiscoveryMessages(hostIdentity(), buildDetectorValues())
+
+# what we announced last, so changes can be published alone
+announced_discovery = OrderedDict()
+# set when our entities changed (e.g. a hotplugged sensor), re-announced with the next report
+discovery_stale = False
+
+def announceDiscovery():
+    global announced_discovery
+    announced_discovery = ownDiscoveryMessages()
+    for [discovery_topic, payload] in announced_discovery.items():
+        publishMQTT(discovery_topic, payload, 1, retain=True)
+
+def updateDiscovery(oldMessages, newMessages):
+    # publish only the discovery configs which changed, remove those no longer wanted
+    removed = [topic for topic in oldMessages if topic not in newMessages]
+    changed = [topic for [topic, payload] in newMessages.items() if oldMessages.get(topic) != payload]
+    for topic in removed:
+        publishMQTT(topic, '', 1, retain=True)
+    for topic in changed:
+        publishMQTT(topic, newMessages[topic], 1, retain=True)
+    print_line('Discovery: {} re-announced, {} removed, {} unchanged', len(changed), len(removed), len(newMessages) - len(changed), verbose=True)
+
+def reannounceDiscovery():
+    global announced_discovery
+    global discovery_stale
+    discovery_stale = False
+    newMessages = ownDiscoveryMessages()
+    updateDiscovery(announced_discovery, newMessages)
+    announced_discovery = newMessages
+
+if relay_mode != RELAY_MODE_AGENT:
+    print_line('Announcing RPi Monitoring device to MQTT broker for auto-discovery ...')
+    announceDiscovery()
 
-    # remove connections as test:                  'connections' : [["mac", mac.lower()], [interface, ipaddr]],
+# -----------------------------------------------------------------------------
+#  Adaptive report interval
+# -----------------------------------------------------------------------------
+#  Fields declaring a deadband are watched.  While each stays within its deadband
+#  of the value last reported, the interval grows by half up to the cap; when one
+#  leaves its deadband the interval is halved, when one nears its threshold the
+#  interval drops straight to the floor.  Sampled values between reports can
+#  pull the next report in early.
+
+ADAPTIVE_GROWTH = 1.5
+
+# value of each watched field at our last report
+adaptive_reference = {}
+
+def watchedFields():
+    for collector in enabledCollectors():
+        for [key, field] in collector.fields.items():
+            if 'deadband' in field:
+                yield key, field
+
+def isNearThreshold(value, field):
+    return 'threshold' in field and value >= field['threshold'] - field['deadband']
+
+def classifyWatchedValues(useHistory):
+    # NOTE: caller holds rpi_values_lock, returns (changed, nearThreshold)
+    changed = False
+    nearThreshold = False
+    for [key, field] in watchedFields():
+        if key not in rpi_values:
+            continue
+        low = high = rpi_values[key]
+        if useHistory and key in rpi_history:
+            # the spread of the values sampled during the interval counts as well
+            low = min(low, rpi_values.get(historyKey(key, 'min'), low))
+            high = max(high, rpi_values.get(historyKey(key, 'max'), high))
+        reference = adaptive_reference.get(key)
+        if reference is not None and max(abs(high - reference), abs(low - reference)) > field['deadband']:
+            changed = True
+        if isNearThreshold(high, field):
+            nearThreshold = True
+    return changed, nearThreshold
+
+def adaptReportInterval():
+    global effective_interval_in_minutes
+    if not adaptive_reporting:
+        return
+    with rpi_values_lock:
+        changed, nearThreshold = classifyWatchedValues(True)
+        firstReport = not adaptive_reference
+        for [key, field] in watchedFields():
+            if key in rpi_values:
+                adaptive_reference[key] = rpi_values[key]
+        if nearThreshold:
+            newInterval = adaptive_min_interval_in_minutes
+        elif firstReport:
+            newInterval = effective_interval_in_minutes
+        elif changed:
+            newInterval = max(adaptive_min_interval_in_minutes, effective_interval_in_minutes // 2)
+        else:
+            newInterval = min(adaptive_max_interval_in_minutes, max(effective_interval_in_minutes + 1, int(round(effective_interval_in_minutes * ADAPTIVE_GROWTH))))
+        if newInterval != effective_interval_in_minutes:
+            print_line('Adaptive: report interval {} -> {} minutes (changed={}, near threshold={})', effective_interval_in_minutes, newInterval, changed, nearThreshold, verbose=True)
+        effective_interval_in_minutes = newInterval
+        # our report carries the interval now in effect (the reporter collector ran before us)
+        rpi_values[SCRIPT_REPORT_INTERVAL] = effective_interval_in_minutes
+
+def checkSampledValues():
+    # a sampled value leaving its deadband (or nearing its threshold) brings the next report forward
+    global effective_interval_in_minutes
+    if not adaptive_reporting:
+        return
+    with rpi_values_lock:
+        changed, nearThreshold = classifyWatchedValues(False)
+        if not (changed or nearThreshold) or effective_interval_in_minutes == adaptive_min_interval_in_minutes:
+            return
+        effective_interval_in_minutes = adaptive_min_interval_in_minutes
+    if report_due_monotonic - monotonic() > adaptive_min_interval_in_minutes * 60.0:
+        print_line('Adaptive: sampled values changed, next report within {} minutes', adaptive_min_interval_in_minutes, verbose=True)
+        rescheduleReport()
 
 # -----------------------------------------------------------------------------
 #  timer and timer funcs for period handling
@@ -798,14 +2735,61 @@ def periodTimeoutHandler():
     handle_interrupt(TIMER_INTERRUPT) # '0' means we have a timer interrupt!!!
     startPeriodTimer()
 
+# spread scheduling: we keep our schedule on the monotonic clock (immune to the wall
+#  clock being stepped, e.g. by NTP after boot on an RPi without RTC) and correct it
+#  each period toward the nearest wall clock boundary plus our phase offset
+MAX_SCHEDULE_DRIFT_IN_SECONDS = 5.0
+next_report_monotonic = None
+
+def reportPhaseOffset(intervalSeconds):
+    # stable per node, derived from our uniqID so nodes spread evenly over the interval
+    digest = hashlib.sha1(uniqID.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % int(intervalSeconds)
+
+def nextReportDelay():
+    global next_report_monotonic
+    intervalSeconds = effective_interval_in_minutes * 60.0
+    if report_scheduling != REPORT_SCHEDULING_SPREAD:
+        return intervalSeconds
+    offset = reportPhaseOffset(intervalSeconds)
+    nowWall = time()
+    nowMonotonic = monotonic()
+    if next_report_monotonic is None:
+        # first period: next boundary at least half an interval away
+        delay = intervalSeconds - ((nowWall - offset) % intervalSeconds)
+        if delay < intervalSeconds / 2:
+            delay += intervalSeconds
+    else:
+        delay = next_report_monotonic + intervalSeconds - nowMonotonic
+        expectedWall = nowWall + delay
+        alignedWall = round((expectedWall - offset) / intervalSeconds) * intervalSeconds + offset
+        drift = alignedWall - expectedWall
+        if abs(drift) > MAX_SCHEDULE_DRIFT_IN_SECONDS:
+            print_line('- PERIOD schedule re-aligned by {:.1f} seconds', drift, verbose=True)
+        delay = max(delay + drift, 1.0)
+    next_report_monotonic = nowMonotonic + delay
+    print_line('- PERIOD phase offset {} seconds, next report in {:.1f} seconds', offset, delay, debug=True)
+    return delay
+
 def startPeriodTimer():
     global endPeriodTimer
     global periodTimeRunningStatus
-    stopPeriodTimer()
-    endPeriodTimer = threading.Timer(interval_in_minutes * 60.0, periodTimeoutHandler)
-    endPeriodTimer.start()
-    periodTimeRunningStatus = True
-    print_line('- started PERIOD timer - every {} seconds'.format(interval_in_minutes * 60.0), debug=True)
+    global report_due_monotonic
+    with periodTimerLock:
+        stopPeriodTimer()
+        delay = nextReportDelay()
+        endPeriodTimer = threading.Timer(delay, periodTimeoutHandler)
+        endPeriodTimer.start()
+        report_due_monotonic = monotonic() + delay
+        periodTimeRunningStatus = True
+    print_line('- started PERIOD timer - in {} seconds', delay, debug=True)
+
+def rescheduleReport():
+    # the interval changed mid-period: schedule afresh from now
+    global next_report_monotonic
+    with periodTimerLock:
+        next_report_monotonic = None
+        startPeriodTimer()
 
 def stopPeriodTimer():
     global endPeriodTimer
@@ -820,148 +2804,316 @@ def isPeriodTimerRunning():
 
 # our TIMER
 endPeriodTimer = threading.Timer(interval_in_minutes * 60.0, periodTimeoutHandler)
+# (re)starts can come from the period, sample and reload threads
+periodTimerLock = threading.RLock()
+report_due_monotonic = 0.0
 # our BOOL tracking state of TIMER
 periodTimeRunningStatus = False
 reported_first_time = False
 
 # -----------------------------------------------------------------------------
-#  MQTT Transmit Helper Routines
+#  timer and timer funcs for sampling between reports
 # -----------------------------------------------------------------------------
-SCRIPT_TIMESTAMP = "timestamp"
-RPI_MODEL = "rpi_model"
-RPI_CONNECTIONS = "ifaces"
-RPI_HOSTNAME = "host_name"
-RPI_FQDN = "fqdn"
-RPI_LINUX_RELEASE = "os_release"
-RPI_LINUX_VERSION = "os_kernel_version"
-RPI_UPTIME = "up_time"
-RPI_LOAD_1M = "load_1m"
-RPI_LOAD_5M = "load_5m"
-RPI_LOAD_15M = "load_15m"
-RPI_DATE_LAST_UPDATE = "last_update"
-RPI_FS_SPACE = 'root_fs_total'
-RPI_FS_AVAIL = 'root_fs_used_percent'
-RPI_CPU_TEMP = "cpu_temperature"
-RPI_SCRIPT = "reporter"
-SCRIPT_REPORT_INTERVAL = "report_interval"
-# new memory dictionary
-RPI_MEM_TOTAL = "memory_size"
-RPI_MEM_AVAIL = "memory_available"
-RPI_MEM_FREE = "memory_free"
-# Tuple (Hardware, Model Name, NbrCores, Serial)
-RPI_CPU_VENDOR = "cpu_vendor"
-RPI_CPU_MODEL = "cpu_model"
-RPI_CPU_ARCHITECTURE= "cpu_architecture"
-RPI_CPU_BOGOMIPS = "cpu_bogomips"
-RPI_CPU_CORES = "cpu_number_of_cores"
-
-def send_status(timestamp, nothing):
-    rpiData = OrderedDict()
-    rpiData[SCRIPT_TIMESTAMP] = timestamp.astimezone().replace(microsecond=0).isoformat()
-    rpiData[RPI_MODEL] = rpi_model
-    rpiData[RPI_CONNECTIONS] = rpi_connections
-    rpiData[RPI_HOSTNAME] = rpi_hostname
-    rpiData[RPI_FQDN] = rpi_fqdn
-    rpiData[RPI_LINUX_RELEASE] = rpi_linux_release
-    rpiData[RPI_LINUX_VERSION] = rpi_linux_version
-    rpiData[RPI_UPTIME] = rpi_uptime
-
-    rpiData[RPI_LOAD_1M] = float(rpi_load_1m)
-    rpiData[RPI_LOAD_5M] = float(rpi_load_5m)
-    rpiData[RPI_LOAD_15M] = float(rpi_load_15m)
-
-    #  DON'T use V1 form of getting date (my dashbord mech)
-    #actualDate = datetime.strptime(rpi_last_update_date, '%y%m%d%H%M%S')
-    #actualDate.replace(tzinfo=local_tz)
-    #rpiData[RPI_DATE_LAST_UPDATE] = actualDate.astimezone().replace(microsecond=0).isoformat()
-    # also don't use V2 form...
-    #if rpi_last_update_date_v2 != datetime.min:
-    #    rpiData[RPI_DATE_LAST_UPDATE] = rpi_last_update_date_v2.astimezone().replace(microsecond=0).isoformat()
-    #else:
-    #    rpiData[RPI_DATE_LAST_UPDATE] = ''
-    if rpi_last_update_date != datetime.min:
-        rpiData[RPI_DATE_LAST_UPDATE] = rpi_last_update_date.astimezone().replace(microsecond=0).isoformat()
-    else:
-        rpiData[RPI_DATE_LAST_UPDATE] = ''
-    rpiData[RPI_FS_SPACE] = int(rpi_filesystem_space.replace('GB', ''),10)
-    rpiData[RPI_FS_AVAIL] = int(rpi_filesystem_percent,10)
-
-    rpiRam = getMemoryDictionary()
-    if len(rpiRam) > 0:
-        rpiData[RPI_MEM_TOTAL] = float(rpiRam[RPI_MEM_TOTAL])
-        rpiData[RPI_MEM_AVAIL] = float(rpiRam[RPI_MEM_AVAIL])
-        rpiData[RPI_MEM_FREE] = float(rpiRam[RPI_MEM_FREE])
-
-    rpiCpu = getCPUDictionary()
-    if len(rpiCpu) > 0:
-        rpiData[RPI_CPU_VENDOR] = rpiCpu[RPI_CPU_VENDOR]
-        rpiData[RPI_CPU_MODEL] = rpiCpu[RPI_CPU_MODEL]
-        rpiData[RPI_CPU_ARCHITECTURE] = rpiCpu[RPI_CPU_ARCHITECTURE]
-        rpiData[RPI_CPU_BOGOMIPS] = float(rpiCpu[RPI_CPU_BOGOMIPS])
-        rpiData[RPI_CPU_CORES] = int(rpiCpu[RPI_CPU_CORES])
 
-    rpiData[RPI_CPU_TEMP] = forceSingleDigit(rpi_cpu_temp)
+def sampleTimeoutHandler():
+    print_line('- SAMPLE TIMER INTERRUPT -', debug=True)
+    runCollectors(sampling=True)
+    checkSampledValues()
+    startSampleTimer()
+
+def startSampleTimer():
+    global sampleTimer
+    global sampleTimerRunningStatus
+    stopSampleTimer()
+    sampleTimer = threading.Timer(sample_interval_in_seconds, sampleTimeoutHandler)
+    sampleTimer.start()
+    sampleTimerRunningStatus = True
+    print_line('- started SAMPLE timer - every {} seconds', sample_interval_in_seconds, debug=True)
+
+def stopSampleTimer():
+    global sampleTimer
+    global sampleTimerRunningStatus
+    sampleTimer.cancel()
+    sampleTimerRunningStatus = False
+    print_line('- stopped SAMPLE timer', debug=True)
+
+# our SAMPLE TIMER
+sampleTimer = threading.Timer(sample_interval_in_seconds, sampleTimeoutHandler)
+# our BOOL tracking state of SAMPLE TIMER
+sampleTimerRunningStatus = False
 
-    rpiData[RPI_SCRIPT] = rpi_mqtt_script.replace('.py', '')
-    rpiData[SCRIPT_REPORT_INTERVAL] = interval_in_minutes
+# -----------------------------------------------------------------------------
+#  MQTT Transmit Helper Routines
+# -----------------------------------------------------------------------------
 
+def send_status(timestamp, nothing):
     rpiTopDict = OrderedDict()
-    rpiTopDict[LDS_PAYLOAD_NAME] = rpiData
+    rpiTopDict[LDS_PAYLOAD_NAME] = buildMonitorData(timestamp)
 
-    _thread.start_new_thread(publishMonitorData, (rpiTopDict, values_topic))
+    if relay_mode == RELAY_MODE_AGENT:
+        sendSnapshotToRelay(rpiTopDict)
+    else:
+        if discovery_stale:
+            reannounceDiscovery()
+        _thread.start_new_thread(publishMonitorData, (rpiTopDict, values_topic))
+
+def publishMonitorPayload(latestData, topic, intervalInMinutes=None):
+    payload = json.dumps(latestData)
+    print_line('Publishing to MQTT topic "{}, Data:{}"', topic, payload)
+    # aliased publishes can't be resent on a new connection: with aliases a report is sent
+    #  once (QoS 0), a lost one is replaced by the next and a late one dropped by its expiry
+    qos = 0 if mqtt_protocol_v5 and mqtt_topic_aliases_enabled else 1
+    publishMQTT('{}'.format(topic), payload, qos, alias=True, expire=True, intervalInMinutes=intervalInMinutes)
 
-def forceSingleDigit(temperature):
-    tempInterp = '{:.1f}'.format(temperature)
-    return float(tempInterp)
+def publishMonitorData(latestData, topic):
+    publishMonitorPayload(latestData, topic)
+    sleep(0.5) # some slack for the publish roundtrip and callback function
+    logMQTTStats()
 
-def getMemoryDictionary():
-    # TYPICAL:
-    #   Tuple (Total, Free, Avail.)
-    memoryData = OrderedDict()
-    if rpi_memory_tuple != '':
-        memoryData[RPI_MEM_TOTAL] = '{:.2f}'.format(rpi_memory_tuple[0])
-        memoryData[RPI_MEM_FREE] = '{:.2f}'.format(rpi_memory_tuple[1])
-        memoryData[RPI_MEM_AVAIL] = '{:.2f}'.format(rpi_memory_tuple[2])
-    #print_line('memoryData:{}"'.format(memoryData), debug=True)
-    return memoryData
+# -----------------------------------------------------------------------------
+#  On-demand refresh (command topic)
+# -----------------------------------------------------------------------------
+#  '{base_topic}/set' accepts  refresh  (report now) and  refresh:{collector}
+#  (re-run that collector, then report).  Requests arriving together are
+#  coalesced into one report, reports are at least min_refresh_interval apart
+#  and a collector which ran within refresh_max_age is not re-run: the cached
+#  value is reported.  A burst from dashboards costs one report, not a fork each.
+
+COMMAND_REFRESH = 'refresh'
+
+refresh_lock = threading.Lock()
+refresh_pending = set()     # collector names to re-run, COMMAND_REFRESH for all
+refresh_timer = None
+last_refresh_monotonic = None
+
+def handleCommand(command):
+    # NOTE: called on the MQTT network thread, must not block
+    global refresh_timer
+    verb, _, collectorName = command.strip().lower().partition(':')
+    if verb != COMMAND_REFRESH:
+        print_line('Command "{}" not understood, ignored', command, warning=True)
+        return
+    if collectorName:
+        collector = collectorRegistry.get(collectorName)
+        if collector is None or not collector.enabled:
+            print_line('Command "{}": no enabled collector "{}", ignored', command, collectorName, warning=True)
+            return
+    with refresh_lock:
+        refresh_pending.add(collectorName if collectorName else COMMAND_REFRESH)
+        if refresh_timer is not None:
+            print_line('Command "{}" joins the pending refresh', command, debug=True)
+            return
+        delay = 0.0
+        if last_refresh_monotonic is not None:
+            delay = max(last_refresh_monotonic + min_refresh_interval_in_seconds - monotonic(), 0.0)
+        refresh_timer = threading.Timer(delay, refreshTimeoutHandler)
+        refresh_timer.start()
+    print_line('Command "{}", refresh in {:.1f} seconds', command, delay, verbose=True)
+
+def refreshTimeoutHandler():
+    global refresh_timer
+    global last_refresh_monotonic
+    with refresh_lock:
+        requested = set(refresh_pending)
+        refresh_pending.clear()
+        refresh_timer = None
+        last_refresh_monotonic = monotonic()
+    if COMMAND_REFRESH in requested:
+        requested = [collector.name for collector in enabledCollectors() if collector.period != PERIOD_ONCE]
+    now = time()
+    stale = [name for name in requested if collectorRegistry[name].last_run is None or now - collectorRegistry[name].last_run > refresh_max_age_in_seconds]
+    print_line('Refresh: re-running {}, cached {}', stale, [name for name in requested if name not in stale], verbose=True)
+    runCollectors(only=stale)
+    send_status(datetime.now(local_tz), '')
 
-def getCPUDictionary():
-    # TYPICAL:
-    #   Tuple (Hardware, Model Name, NbrCores, BogoMIPS, Serial)
-    cpuDict = OrderedDict()
-    #print_line('rpi_cpu_tuple:{}"'.format(rpi_cpu_tuple), debug=True)
-    if rpi_cpu_tuple != '':
-        cpuDict[RPI_CPU_VENDOR] = rpi_cpu_tuple[0]
-        cpuDict[RPI_CPU_MODEL] = rpi_cpu_tuple[1]
-        cpuDict[RPI_CPU_ARCHITECTURE] = rpi_cpu_tuple[2]
-        cpuDict[RPI_CPU_BOGOMIPS] = rpi_cpu_tuple[3]
-        cpuDict[RPI_CPU_CORES] = rpi_cpu_tuple[4]
-
-    print_line('cpuDict:{}"'.format(cpuDict), debug=True)
-    return cpuDict
+# -----------------------------------------------------------------------------
+#  Relay (aggregator) mode
+# -----------------------------------------------------------------------------
+#  agent: does not connect to MQTT, each report is sent as one compact datagram
+#   (zlib compressed JSON) to the relay over UDP or a Unix datagram socket.
+#  relay: reports for itself as usual and also listens for agent snapshots,
+#   republishing each agent's discovery, status and monitor topics through its
+#   one broker connection.  Agents that stop reporting are marked offline.
+
+RELAY_MAGIC_PLAIN = b'RPR1'
+RELAY_MAGIC_SIGNED = b'RPS1'
+RELAY_SIGNATURE_LENGTH = 16
+RELAY_MAX_DATAGRAM = 65507
+# agents resend their discovery table every N snapshots (and whenever it changes)
+RELAY_DISCOVERY_EVERY = 12
+# agents missing this many of their report intervals are marked offline
+RELAY_MISSED_REPORTS_OFFLINE = 3
+RELAY_CHECK_IN_SECONDS = 60
+
+def relaySignature(body):
+    return hmac.new(relay_shared_secret.encode('utf-8'), body, hashlib.sha256).digest()[:RELAY_SIGNATURE_LENGTH]
+
+def encodeRelayMessage(message):
+    body = zlib.compress(json.dumps(message, separators=(',', ':')).encode('utf-8'))
+    if relay_shared_secret:
+        return RELAY_MAGIC_SIGNED + relaySignature(body) + body
+    return RELAY_MAGIC_PLAIN + body
+
+def decodeRelayMessage(datagram):
+    magic = datagram[:len(RELAY_MAGIC_PLAIN)]
+    body = datagram[len(RELAY_MAGIC_PLAIN):]
+    if magic == RELAY_MAGIC_SIGNED:
+        signature = body[:RELAY_SIGNATURE_LENGTH]
+        body = body[RELAY_SIGNATURE_LENGTH:]
+        if not relay_shared_secret or not hmac.compare_digest(signature, relaySignature(body)):
+            raise ValueError('bad signature')
+    elif magic != RELAY_MAGIC_PLAIN or relay_shared_secret:
+        raise ValueError('unsigned or unknown message')
+    return json.loads(zlib.decompress(body).decode('utf-8'))
+
+# --- agent side ---
+
+relay_agent_socket = None
+relay_agent_sent = 0
+relay_agent_discovery_hash = ''
+
+def sendSnapshotToRelay(latestData):
+    global relay_agent_socket
+    global relay_agent_sent
+    global relay_agent_discovery_hash
+    detectorValues = buildDetectorValues()
+    discoveryHash = hashlib.sha1(json.dumps(detectorValues).encode('utf-8')).hexdigest()[:12]
+    message = OrderedDict()
+    message['id'] = hostIdentity()
+    message['interval'] = effective_interval_in_minutes
+    message['dh'] = discoveryHash
+    if relay_agent_sent % RELAY_DISCOVERY_EVERY == 0 or discoveryHash != relay_agent_discovery_hash:
+        message['disc'] = detectorValues
+    message[LDS_PAYLOAD_NAME] = latestData[LDS_PAYLOAD_NAME]
+    datagram = encodeRelayMessage(message)
+    try:
+        if relay_agent_socket is None:
+            relay_agent_socket = socket.socket(relay_family, socket.SOCK_DGRAM)
+        relay_agent_socket.sendto(datagram, relay_sockaddr)
+    except OSError as e:
+        print_line('Relay send to {} failed: {}'.format(relay_address, e), error=True)
+        return
+    relay_agent_sent += 1
+    relay_agent_discovery_hash = discoveryHash
+    print_line('Sent {} byte snapshot to relay {}', len(datagram), relay_address, verbose=True)
+
+# --- relay side ---
+
+# sensor_name -> dict(sensor=, interval=, last_seen=, online=, discovery_hash=)
+#  (the topics are the agent's sensor_name, several agents can share a MAC)
+relayHosts = OrderedDict()
+relayHostsLock = threading.Lock()
+
+def isTopicLevel(name):
+    # usable as one level of a topic we publish to
+    return isinstance(name, str) and len(name) > 0 and not any(c in name for c in '/+#\0')
+
+def checkRelayMessage(message):
+    # agents' datagrams are unsigned by default, their names end up in our topics
+    identity = message['id']
+    if not isTopicLevel(identity['sensor_name']) or identity['sensor_name'] == sensor_name:
+        raise ValueError('bad sensor_name {}'.format(json.dumps(identity['sensor_name'])))
+    if not isinstance(identity['uniq_id'], str) or identity['uniq_id'] == uniqID:
+        raise ValueError('bad uniq_id {}'.format(json.dumps(identity['uniq_id'])))
+    # the offline check runs on it
+    interval = message.get('interval', default_interval_in_minutes)
+    if isinstance(interval, bool) or not isinstance(interval, (int, float)) or not 0 < interval <= max_interval_in_minutes:
+        raise ValueError('bad interval {}'.format(json.dumps(interval)))
+    for sensor in message.get('disc', {}):
+        if not isTopicLevel(sensor):
+            raise ValueError('bad sensor {}'.format(json.dumps(sensor)))
+
+def handleRelayMessage(message):
+    checkRelayMessage(message)
+    identity = message['id']
+    hostBaseTopic = sensorBaseTopic(identity['sensor_name'])
+    with relayHostsLock:
+        host = relayHosts.get(identity['sensor_name'])
+        if host is None:
+            host = dict(sensor=identity['sensor_name'], online=False, discovery_hash='')
+            relayHosts[identity['sensor_name']] = host
+            print_line('Relay: new agent [{}]', identity['sensor_name'], verbose=True)
+        host['interval'] = message.get('interval', default_interval_in_minutes)
+        host['last_seen'] = time()
+        announce = 'disc' in message and message['dh'] != host['discovery_hash']
+        if announce:
+            host['discovery_hash'] = message['dh']
+        cameOnline = not host['online']
+        host['online'] = True
+    if announce:
+        publishDiscovery(identity, message['disc'], relayed=True)
+    if cameOnline:
+        publishMQTT('{}/status'.format(hostBaseTopic), lwt_online_val, retain=True)
+    rpiTopDict = OrderedDict()
+    rpiTopDict[LDS_PAYLOAD_NAME] = message[LDS_PAYLOAD_NAME]
+    # NOTE: no slack here, the one listener thread serves every agent
+    publishMonitorPayload(rpiTopDict, '{}/{}'.format(hostBaseTopic, LD_MONITOR), message.get('interval', default_interval_in_minutes))
 
-def publishMonitorData(latestData, topic):
-    print_line('Publishing to MQTT topic "{}, Data:{}"'.format(topic, json.dumps(latestData)))
-    mqtt_client.publish('{}'.format(topic), json.dumps(latestData), 1, retain=False)
-    sleep(0.5) # some slack for the publish roundtrip and callback function
+def relayListener(relaySocket):
+    while True:
+        datagram, sender = relaySocket.recvfrom(RELAY_MAX_DATAGRAM)
+        try:
+            message = decodeRelayMessage(datagram)
+            handleRelayMessage(message)
+        except Exception as e:
+            print_line('Relay: dropped datagram from {}: {}'.format(sender, e), warning=True)
+
+def relayCheckHosts():
+    # mark agents which stopped reporting as offline
+    now = time()
+    with relayHostsLock:
+        silentHosts = [host for host in relayHosts.values() if host['online'] and now - host['last_seen'] > RELAY_MISSED_REPORTS_OFFLINE * host['interval'] * 60.0]
+        for host in silentHosts:
+            host['online'] = False
+    for host in silentHosts:
+        print_line('Relay: agent [{}] stopped reporting'.format(host['sensor']), warning=True)
+        publishMQTT('{}/status'.format(sensorBaseTopic(host['sensor'])), lwt_offline_val, retain=True)
+
+def relayCheckTimeoutHandler():
+    try:
+        relayCheckHosts()
+    finally:
+        startRelayCheckTimer()
+
+def startRelayCheckTimer():
+    global relayCheckTimer
+    relayCheckTimer = threading.Timer(RELAY_CHECK_IN_SECONDS, relayCheckTimeoutHandler)
+    relayCheckTimer.daemon = True
+    relayCheckTimer.start()
+
+def startRelay():
+    # NOTE: our timers are running, failing here ends the process with os._exit()
+    relaySocket = socket.socket(relay_family, socket.SOCK_DGRAM)
+    if relay_family == socket.AF_UNIX and os.path.exists(relay_sockaddr):
+        if not S_ISSOCK(os.stat(relay_sockaddr).st_mode):
+            print_line('Relay: {} exists and is not a socket, not replacing it', relay_sockaddr, error=True, sd_notify=True)
+            os._exit(1)
+        os.unlink(relay_sockaddr)   # stale socket from our last run
+    try:
+        relaySocket.bind(relay_sockaddr)
+    except OSError as e:
+        print_line('Relay: unable to listen on {}: {}'.format(relay_address, e), error=True, sd_notify=True)
+        os._exit(1)
+    listenerThread = threading.Thread(target=relayListener, args=(relaySocket,), name='relay-listener')
+    listenerThread.daemon = True
+    listenerThread.start()
+    startRelayCheckTimer()
+    print_line('Relay: listening for agents on {}', relay_address, verbose=True)
 
 
 def update_values():
-    # nothing here yet
-    getUptimeAndLoad()
-    getFileSystemDrives()
-    getSystemTemperature()
-    getLastUpdateDate()
-    getDeviceMemory()
+    # run every collector that is due
+    runCollectors()
+    updateHistoryAggregates()
+    adaptReportInterval()
 
 # -----------------------------------------------------------------------------
 
 # Interrupt handler
 def handle_interrupt(channel):
     global reported_first_time
-    sourceID = "<< INTR(" + str(channel) + ")"
     current_timestamp = datetime.now(local_tz)
-    print_line(sourceID + " >> Time to report! (%s)" % current_timestamp.strftime('%H:%M:%S - %Y/%m/%d'), verbose=True)
+    print_line('<< INTR({}) >> Time to report! ({:%H:%M:%S - %Y/%m/%d})', channel, current_timestamp, verbose=True)
     # ----------------------------------
     # have PERIOD interrupt!
     update_values()
@@ -971,16 +3123,202 @@ def handle_interrupt(channel):
         _thread.start_new_thread(send_status, (current_timestamp, ''))
         reported_first_time = True
     else:
-        print_line(sourceID + " >> Time to report! (%s) but SKIPPED (TEST: stall)" % current_timestamp.strftime('%H:%M:%S - %Y/%m/%d'), verbose=True)
+        print_line('<< INTR({}) >> Time to report! ({:%H:%M:%S - %Y/%m/%d}) but SKIPPED (TEST: stall)', channel, current_timestamp, verbose=True)
 
 def afterMQTTConnect():
     print_line('* afterMQTTConnect()', verbose=True)
     #  NOTE: this is run after MQTT connects
+    # start listening for our agents
+    if relay_mode == RELAY_MODE_RELAY:
+        startRelay()
     # start our interval timer
     startPeriodTimer()
+    # and our sampling between reports
+    if sample_interval_in_seconds != 0:
+        startSampleTimer()
     # do our first report
     handle_interrupt(0)
 
+# -----------------------------------------------------------------------------
+#  Configuration reload (SIGHUP)
+# -----------------------------------------------------------------------------
+#  kill -HUP re-reads config.ini and applies only what changed:  the period and
+#  sample timers are rescheduled, the discovery entities whose topic or content
+#  changed are re-announced (those that went away are removed) and the broker
+#  connection is only recycled when a setting used to connect changed, the new
+#  connection being made before the running one is closed.  The startup probes
+#  are not re-run.  A bad config.ini, or connection settings the broker refuses,
+#  are reported and the running configuration is kept.
+
+# these only take effect on restart (the relay socket is bound/connected once, the
+#  collectors found their sources below fs_root at startup, our unique id is made once)
+RESTART_SETTINGS = ['relay_mode', 'relay_address', 'relay_family', 'relay_sockaddr', 'fs_root', 'instance_id']
+# used when connecting
+CONNECTION_SETTINGS = ['mqtt_base_topic', 'sensor_name', 'mqtt_protocol_v5', 'session_expiry_in_seconds',
+    'mqtt_hostname', 'mqtt_port', 'mqtt_keepalive', 'mqtt_username', 'mqtt_password',
+    'mqtt_tls', 'mqtt_tls_ca_cert', 'mqtt_tls_keyfile', 'mqtt_tls_certfile']
+SCHEDULE_SETTINGS = ['interval_in_minutes', 'adaptive_reporting', 'adaptive_min_interval_in_minutes', 'adaptive_max_interval_in_minutes', 'report_scheduling']
+HTTP_SETTINGS = ['http_enabled', 'http_bind_address', 'http_port']
+
+MQTT_RELOAD_CONNECT_TIMEOUT_IN_SECONDS = 15
+
+reload_lock = threading.Lock()
+
+def awaitConnack(client):
+    # run the (not yet started) client's network loop until the broker answers its
+    #  CONNECT -> (rc, flags, properties), rc is None when it didn't answer in time
+    connack = []
+    client.on_connect = lambda client, userdata, flags, rc, properties=None: connack.append((rc, flags, properties))
+    deadline = monotonic() + MQTT_RELOAD_CONNECT_TIMEOUT_IN_SECONDS
+    while not connack and monotonic() < deadline:
+        if client.loop(timeout=1.0) != mqtt.MQTT_ERR_SUCCESS:
+            break
+    client.on_connect = on_connect
+    return connack[0] if connack else (None, {}, None)
+
+def closeMQTTClient(client, endSession):
+    # a clean disconnect doesn't fire the will
+    properties = None
+    if endSession:
+        # v5: the broker drops the session (and the subscription it holds) along with us
+        properties = Properties(PacketTypes.DISCONNECT)
+        properties.SessionExpiryInterval = 0
+    client.disconnect(properties=properties)
+    client.loop_stop()
+
+def applyConfig(newConfig, settings):
+    global config
+    config = newConfig
+    applySettings(settings)
+    resolveSensorName()
+    setupTopics()
+
+def reconnectMQTT(newConfig, newSettings):
+    # apply the new settings and move to a connection made with them, the running
+    #  one is only let go once the broker accepted the new one -> False when it
+    #  can't be reached or refuses them: the running settings and connection are kept
+    global mqtt_client
+    print_line('Reload: reconnecting to the MQTT broker', verbose=True)
+    oldConfig, oldSettings = config, running_settings
+    oldClient, oldClientID, oldLwtTopic = mqtt_client, mqttClientID(), lwt_topic
+    oldBroker = (mqtt_hostname, mqtt_port)
+    applyConfig(newConfig, newSettings)
+    # a broker keeps one connection per client id, the old one has to go first
+    takeover = oldClientID != '' and mqttClientID() == oldClientID and (mqtt_hostname, mqtt_port) == oldBroker
+    rc, failure = None, 'no answer from the broker'
+    try:
+        newClient = newMQTTClient()
+    except Exception as e:
+        newClient, failure = None, e
+    if newClient is not None:
+        stopAliveTimer()
+        if takeover:
+            closeMQTTClient(oldClient, False)
+        try:
+            # a clean start: the session we'd resume holds the command topic we subscribed before
+            connectMQTTClient(newClient, cleanStart=True)
+            rc, flags, properties = awaitConnack(newClient)
+            if rc is not None and rc != 0:
+                failure = mqtt.connack_string(rc) if isinstance(rc, int) else rc
+        except Exception as e:
+            failure = e
+    if rc is None or rc != 0:
+        print_line('Reload: keeping the running configuration, connecting with the new MQTT settings failed: {}', failure, error=True, sd_notify=True)
+        applyConfig(oldConfig, oldSettings)
+        if newClient is None:
+            return False
+        newClient.disconnect()
+        if takeover:
+            try:
+                oldClient.reconnect()
+            except Exception as e:
+                # as at startup, no broker no daemon (we're not on the main thread here)
+                print_line('MQTT connection error: {}', e, error=True, sd_notify=True)
+                os._exit(1)
+            publishMQTT(lwt_topic, lwt_online_val)
+            oldClient.loop_start()
+        startAliveTimer()
+        return False
+    if not takeover:
+        if oldLwtTopic != lwt_topic:
+            oldClient.publish(oldLwtTopic, lwt_offline_val, retain=True)
+        closeMQTTClient(oldClient, oldClientID != '')
+    mqtt_client = newClient
+    if takeover and oldLwtTopic != lwt_topic:
+        publishMQTT(oldLwtTopic, lwt_offline_val, retain=True)
+    on_connect(newClient, None, flags, rc, properties)
+    publishMQTT(lwt_topic, lwt_online_val)
+    newClient.loop_start()
+    startAliveTimer()
+    return True
+
+def reloadConfig():
+    global rpi_fqdn
+    global effective_interval_in_minutes
+    with reload_lock:
+        try:
+            newConfig = readConfigFile()
+            newSettings = readSettings(newConfig)
+            readCollectorSelection(newConfig)
+        except Exception as e:
+            print_line('Reload: keeping the running configuration, config.ini: {}', e, error=True, sd_notify=True)
+            return
+        for name in RESTART_SETTINGS:
+            if newSettings[name] != running_settings[name]:
+                print_line('Reload: a change of "{}" needs a restart, ignored', name, warning=True)
+                newSettings[name] = running_settings[name]
+        changed = [name for name in newSettings if newSettings[name] != running_settings[name]]
+        collectorsChanged = dict(newConfig['Collectors']) != dict(config['Collectors'])
+        if not (changed or collectorsChanged):
+            print_line('Reload: config.ini unchanged', sd_notify=True)
+            return
+        print_line('Reload: changed {}{}', changed, ' [Collectors]' if collectorsChanged else '', sd_notify=True)
+
+        reconnect = mqtt_client is not None and any(name in changed for name in CONNECTION_SETTINGS)
+        if reconnect:
+            if not reconnectMQTT(newConfig, newSettings):
+                return
+        else:
+            applyConfig(newConfig, newSettings)
+        if 'fallback_domain' in changed:
+            with rpi_values_lock:
+                rpi_values.update(qualifyHostname(rpi_values[RPI_FQDN_RAW]))
+            rpi_fqdn = getValue(RPI_FQDN)
+        if collectorsChanged:
+            applyCollectorSelection()
+            # newly enabled static collectors are run now, the others at the next report
+            runCollectors(static_only=True)
+        if collectorsChanged or 'sample_interval_in_seconds' in changed or any(name in changed for name in SCHEDULE_SETTINGS):
+            setupHistory()
+        if any(name in changed for name in HTTP_SETTINGS):
+            restartMetricsServer()
+        if any(name in changed for name in SCHEDULE_SETTINGS):
+            effective_interval_in_minutes = interval_in_minutes
+            rescheduleReport()
+        if 'sample_interval_in_seconds' in changed:
+            stopSampleTimer()
+            if sample_interval_in_seconds != 0:
+                startSampleTimer()
+        if 'commands_enabled' in changed and mqtt_client is not None and not reconnect:
+            # on the live connection (a new one subscribes as it connects)
+            if commands_enabled:
+                mqtt_client.subscribe(command_topic, qos=1)
+            else:
+                mqtt_client.unsubscribe(command_topic)
+        if mqtt_client is not None:
+            reannounceDiscovery()
+            if any(name in changed for name in ['discovery_prefix', 'mqtt_base_topic', 'sensor_name']) and relay_mode == RELAY_MODE_RELAY:
+                # our agents (their topics and our status in their availability) are re-announced with their next discovery table
+                with relayHostsLock:
+                    for host in relayHosts.values():
+                        host['discovery_hash'] = ''
+
+def handle_sighup(signum, frame):
+    # not in the signal handler: reloading publishes and may wait on the broker
+    _thread.start_new_thread(reloadConfig, ())
+
+signal(SIGHUP, handle_sighup)
+
 # TESTING AGAIN
 #getNetworkIFs()
 #getLastUpdateDate()
@@ -1000,4 +3338,5 @@ try:
 finally:
     # cleanup used pins... just because we like cleaning up after us
     stopPeriodTimer()   # don't leave our timers running!
+    stopSampleTimer()
     stopAliveTimer()